@@ -0,0 +1,163 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from extraction import EXTRACTION_CONCURRENCY, GeminiExtractionClient, extract_file
+from extraction_cache import CACHE_DISABLED, ExtractionCache
+from history_store import HISTORY_DISABLED, HistoryStore
+from page_images import IMAGE_PATH_ENABLED, configure_renderer
+from pdf_chunks import count_pages
+from pdf_text import TEXT_PATH_ENABLED
+from rate_limit import GEMINI_REQUESTS_PER_MINUTE, RateLimitedClient, configure_limiter
+from remote_files import get_registry
+
+# Headless counterpart of the Streamlit app: extracts whole folders into a JSONL file and can resume
+
+_worker_client = None
+
+def find_pdfs(inputs):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = glob.glob(os.path.join(item, "**", "*.pdf"), recursive=True)
+        else:
+            matches = glob.glob(item, recursive=True)
+        paths.extend(match for match in sorted(matches) if match.lower().endswith(".pdf"))
+    return list(dict.fromkeys(paths))
+
+def load_manifest(manifest_path):
+    finished = {}
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write leaves a partial last line
+                continue
+            if entry.get("status") == "done":
+                finished[entry["file"]] = entry["sha256"]
+    return finished
+
+def _append_line(path, record):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def _init_worker(workers):
+    global _worker_client
+    from dotenv import load_dotenv
+    import google.generativeai as genai
+
+    load_dotenv()
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    # Each process has its own limiter, so the request quota is split between them
+    limiter = configure_limiter("gemini", requests_per_minute=GEMINI_REQUESTS_PER_MINUTE / workers)
+    _worker_client = RateLimitedClient(GeminiExtractionClient(), limiter)
+    # The batch is already spread over worker processes, so each renders its scanned pages in-process
+    configure_renderer(1)
+    get_registry().purge_expired()
+
+def process_file(path, client=None, use_cache=not CACHE_DISABLED, use_text_layer=TEXT_PATH_ENABLED, use_images=IMAGE_PATH_ENABLED):
+    client = client or _worker_client
+    started = time.perf_counter()
+    with open(path, "rb") as f:
+        file_bytes = f.read()
+    record = {"file": path, "sha256": hashlib.sha256(file_bytes).hexdigest(), "pages": 0, "data": None, "error": None}
+    try:
+        record["pages"] = count_pages(file_bytes)
+    except Exception:
+        pass
+    try:
+        info = extract_file(client, os.path.basename(path), file_bytes, ExtractionCache(enabled=use_cache), use_text_layer, use_images=use_images)
+        record.update(info)
+        if record["data"] is None:
+            record["error"] = "No JSON object found in model response"
+    except Exception as e:
+        record["error"] = str(e)
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+def run_batch(paths, output_path, manifest_path, workers=EXTRACTION_CONCURRENCY, client=None, use_cache=not CACHE_DISABLED, use_text_layer=TEXT_PATH_ENABLED, history=None, use_images=IMAGE_PATH_ENABLED, log=print):
+    finished = load_manifest(manifest_path)
+    pending = []
+    for path in paths:
+        if path in finished:
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() == finished[path]:
+                    continue
+        pending.append(path)
+    log(f"{len(paths)} file(s) found, {len(paths) - len(pending)} already done, {len(pending)} to extract")
+
+    started = time.perf_counter()
+    totals = {"files": 0, "pages": 0, "errors": 0}
+    if pending:
+        # A stub client lives in this process, so it runs on threads; the real client gets one per worker process
+        if client is not None:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            submit = lambda path: executor.submit(process_file, path, client, use_cache, use_text_layer, use_images)
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(workers,))
+            submit = lambda path: executor.submit(process_file, path, None, use_cache, use_text_layer, use_images)
+
+        with executor:
+            futures = [submit(path) for path in pending]
+            for future in as_completed(futures):
+                record = future.result()
+                status = "error" if record["error"] else "done"
+                # The result line is written before the manifest entry, so a killed run never marks a file done without output
+                if status == "done":
+                    _append_line(output_path, record)
+                    if history is not None:
+                        history.record_document(record["data"], file_name=os.path.basename(record["file"]), doc_hash=record["sha256"])
+                _append_line(manifest_path, {"file": record["file"], "sha256": record["sha256"], "status": status, "pages": record["pages"], "seconds": record["seconds"], "error": record["error"]})
+                totals["files"] += 1
+                totals["pages"] += record["pages"]
+                totals["errors"] += status == "error"
+                log(f"[{totals['files']}/{len(pending)}] {status}: {record['file']} ({record['seconds']}s)")
+
+    elapsed = time.perf_counter() - started
+    minutes = max(elapsed, 1e-9) / 60
+    totals["seconds"] = round(elapsed, 2)
+    totals["files_per_minute"] = round(totals["files"] / minutes, 2) if totals["files"] else 0.0
+    totals["pages_per_minute"] = round(totals["pages"] / minutes, 2) if totals["pages"] else 0.0
+    log(
+        f"Extracted {totals['files']} file(s), {totals['pages']} page(s) in {totals['seconds']}s "
+        f"({totals['files_per_minute']} files/min, {totals['pages_per_minute']} pages/min, {totals['errors']} error(s))"
+    )
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract quotation PDFs from folders or globs into a JSONL file")
+    parser.add_argument("inputs", nargs="+", help="directories (searched recursively) or glob patterns")
+    parser.add_argument("-o", "--output", default="extracted_data.jsonl", help="JSONL file that receives one result per PDF")
+    parser.add_argument("--manifest", help="progress manifest used to resume (default: <output>.manifest)")
+    parser.add_argument("-w", "--workers", type=int, default=EXTRACTION_CONCURRENCY, help="worker processes")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the extraction cache")
+    parser.add_argument("--no-text-layer", action="store_true", help="do not send the PDF text layer; PDFs with text pages are uploaded as they are, fully scanned ones still go as images")
+    parser.add_argument("--no-images", action="store_true", help="upload scanned PDFs as they are instead of rendering their pages to images")
+    parser.add_argument("--no-history", action="store_true", help="do not add the extracted line items to the price history")
+    args = parser.parse_args(argv)
+
+    paths = find_pdfs(args.inputs)
+    manifest_path = args.manifest or f"{args.output}.manifest"
+    totals = run_batch(
+        paths,
+        args.output,
+        manifest_path,
+        workers=args.workers,
+        use_cache=not args.no_cache and not CACHE_DISABLED,
+        use_text_layer=not args.no_text_layer and TEXT_PATH_ENABLED,
+        history=None if args.no_history or HISTORY_DISABLED else HistoryStore(),
+        use_images=not args.no_images and IMAGE_PATH_ENABLED
+    )
+    return 1 if totals["errors"] else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,222 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import random
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import metrics
+from extraction import extract_files_concurrently
+from fakes import FakeWorksheet, StubExtractionClient, StubMatchingModel, ThrottleSchedule
+from rate_limit import RateLimitedClient, configure_limiter
+from sheets import HEADER_ROW, ITEM_MASTER_LIST_COL, SheetModel, SupplierFeed, update_google_sheet_with_multiple_files
+
+# Offline benchmark of extract -> match -> sheet update using the stubs in fakes.py; no network access needed
+
+DEFAULT_PDF_DIRS = ["DataPDF/level1", "DataPDF/level2", "DataPDF/level3"]
+SUMMARY_LABELS = {
+    "ราคารวม": "totalPrice",
+    "ภาษีมูลค่าเพิ่ม 7%": "totalVat",
+    "ยอดรวมทั้งสิ้น": "totalPriceIncludeVat",
+}
+
+def _number(value):
+    try:
+        return float(str(value).replace(",", ""))
+    except ValueError:
+        return None
+
+def load_csv_recording(csv_path):
+    # extracted_data_final.csv is the flat CSV layout from test.py; convert it to the JSON shape used by template.py
+    document = {"company": "", "vat": False, "name": None, "contact": None, "priceGuaranteeDay": 0, "products": [], "totalPrice": 0, "totalVat": 0, "totalPriceIncludeVat": 0}
+    with open(csv_path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.reader(f):
+            row = (row + [""] * 7)[:7]
+            contact, _, label, quantity, unit, price, total = row
+            if contact and not document["company"]:
+                document["company"] = contact.split(":", 1)[-1].strip()
+                continue
+            if label in SUMMARY_LABELS and _number(total) is not None:
+                document[SUMMARY_LABELS[label]] = _number(total)
+                continue
+            if _number(quantity) is not None and _number(price) is not None:
+                document["products"].append({
+                    "name": label,
+                    "quantity": _number(quantity),
+                    "unit": unit,
+                    "pricePerUnit": _number(price),
+                    "totalPrice": _number(total) or _number(quantity) * _number(price)
+                })
+    document["vat"] = document["totalVat"] > 0
+    return document
+
+def load_recorded_outputs(json_path="extracted_data.json", csv_path="extracted_data_final.csv"):
+    documents = []
+    if os.path.exists(json_path):
+        with open(json_path, encoding="utf-8") as f:
+            recorded = json.load(f)
+        documents.extend(recorded.get("extractions", recorded) if isinstance(recorded, dict) else recorded)
+    if os.path.exists(csv_path):
+        documents.append(load_csv_recording(csv_path))
+    return documents
+
+def replay_workload(pdf_dirs=DEFAULT_PDF_DIRS, recordings=None):
+    # Every sample PDF is paired with one of the recorded outputs in turn
+    recordings = recordings or load_recorded_outputs()
+    paths = sorted(path for directory in pdf_dirs for path in glob.glob(os.path.join(directory, "**", "*.pdf"), recursive=True))
+    files = []
+    responses = {}
+    for i, path in enumerate(paths):
+        name = f"{i:03d}_{os.path.basename(path)}"
+        with open(path, "rb") as f:
+            files.append((name, f.read()))
+        responses[name] = recordings[i % len(recordings)]
+    return FakeWorksheet(), files, responses
+
+def _synthetic_name(rng, serial):
+    function = rng.choice(["งานราวกันตก", "งานราวบันได", "ประตูบานเลื่อน", "หน้าต่างบานสวิง", "ฉากกั้นอาบน้ำ"])
+    glass = rng.choice(["เทมเปอร์ใส", "เทมเปอร์ เขียว", "ลามิเนต ใส", "ยูโรเกรย์", "เทมเปอร์ ชาดำ"])
+    thickness = rng.choice([6, 8, 10, 12])
+    return f"{function} ชั้น {rng.randint(1, 8)} กระจก{glass} {thickness} มม. ขนาด {rng.randint(30, 400) / 100:.2f}x{rng.randint(80, 250) / 100:.2f} ม. รหัส {serial}"
+
+def synthetic_workload(suppliers=100, master_items=5000, products_per_supplier=50, known_ratio=0.7, seed=0):
+    rng = random.Random(seed)
+    master = [_synthetic_name(rng, serial) for serial in range(master_items)]
+    rows = [[""] * ITEM_MASTER_LIST_COL for _ in range(HEADER_ROW)] + [["", name] for name in master]
+
+    files = []
+    responses = {}
+    for supplier in range(suppliers):
+        products = []
+        for _ in range(products_per_supplier):
+            if master and rng.random() < known_ratio:
+                # Same item written the way another supplier would: different spacing and unit spelling
+                name = rng.choice(master).replace(" มม.", "มม").replace("x", " x ")
+            else:
+                name = _synthetic_name(rng, master_items + rng.randint(0, 10 ** 6))
+            quantity = rng.randint(1, 20)
+            price = round(rng.uniform(500, 50000), 2)
+            products.append({"name": name, "quantity": quantity, "unit": "ชุด", "pricePerUnit": price, "totalPrice": round(quantity * price, 2)})
+        total = round(sum(product["totalPrice"] for product in products), 2)
+        name = f"supplier_{supplier:04d}.pdf"
+        files.append((name, name.encode("utf-8")))
+        responses[name] = {
+            "company": f"Supplier {supplier}", "vat": True, "name": None, "contact": None, "priceGuaranteeDay": 0,
+            "products": products, "totalPrice": total, "totalVat": round(total * 0.07, 2), "totalPriceIncludeVat": round(total * 1.07, 2)
+        }
+    return FakeWorksheet(rows), files, responses
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+def run_pipeline(
+    worksheet, files, responses, extract_latency=0.0, match_latency=0.0, concurrency=4, use_text_layer=True, trace_memory=False,
+    gemini_quota=None, sheets_quota=None, backoff_base=0.05
+):
+    # gemini_quota / sheets_quota make the stubs reject calls above that many per second, as the real APIs do with 429s
+    gemini_throttle = ThrottleSchedule(per_second=gemini_quota) if gemini_quota else None
+    stub_client = StubExtractionClient(responses, latency=extract_latency, throttle=gemini_throttle)
+    gemini_limiter = configure_limiter("gemini", requests_per_minute=0, max_concurrency=concurrency, max_retries=10, base_delay=backoff_base, max_delay=backoff_base * 32)
+    sheets_limiter = configure_limiter("sheets", requests_per_minute=0, max_retries=10, base_delay=backoff_base, max_delay=backoff_base * 32)
+    client = RateLimitedClient(stub_client, gemini_limiter)
+    if sheets_quota:
+        worksheet.throttle = ThrottleSchedule(per_second=sheets_quota)
+    matching_model = StubMatchingModel(latency=match_latency)
+    run = metrics.start_run(enabled=True)
+
+    # tracemalloc slows pypdf down several times, so it is only used on request
+    if trace_memory:
+        tracemalloc.start()
+    # Matching against the master list starts as each file finishes, while later files are still extracting
+    feed = SupplierFeed(SheetModel(worksheet), matching_model)
+    positions = {name: position for position, (name, _) in enumerate(files)}
+
+    def on_file_done(result, done_count, total):
+        feed.add(positions[result["name"]], result["data"])
+
+    with run.span("extract"):
+        results = extract_files_concurrently(files, client, max_workers=concurrency, on_file_done=on_file_done, use_text_layer=use_text_layer)
+
+    all_data = [result["data"] for result in results if result["data"]]
+    with run.span("match_and_sheet_update"):
+        # Nothing else writes to the fake worksheet during the run, so the feed's copy of it is still current
+        update_google_sheet_with_multiple_files(worksheet, all_data, llm_match=matching_model, batch_matcher=feed.batch_matcher, sheet=feed.sheet)
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory = {"peak_traced_mb": round(peak / (1024 * 1024), 2)}
+    else:
+        memory = {"peak_rss_mb": _peak_rss_mb()}
+
+    report = run.report()
+    spans = report["spans"]
+    return {
+        "files": len(files),
+        "suppliers": len(all_data),
+        "products": sum(len(data["products"]) for data in all_data),
+        "stage_seconds": {stage: spans[stage]["seconds"] for stage in ("extract", "match_and_sheet_update")},
+        "total_seconds": round(spans["extract"]["seconds"] + spans["match_and_sheet_update"]["seconds"], 4),
+        "model_calls": {"extraction": len(stub_client.calls), "matching": matching_model.calls},
+        "files_per_second": round(len(files) / max(spans["extract"]["seconds"], 1e-9), 2),
+        "rate_limiting": {
+            "gemini": dict(gemini_limiter.stats, final_concurrency=round(gemini_limiter.concurrency.limit, 2)),
+            "sheets": dict(sheets_limiter.stats),
+        },
+        "items_sent_to_llm_matching": matching_model.items,
+        "extraction_paths": {path: sum(result["path"] == path for result in results) for path in {result["path"] for result in results}},
+        "sheets_calls": dict(worksheet.calls, total=worksheet.call_count),
+        "cells_written": worksheet.cells_written,
+        "memory": memory,
+        "metrics": report
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the extraction, matching and sheet update pipeline")
+    parser.add_argument("workload", choices=["replay", "synthetic"], help="replay the DataPDF samples or generate a synthetic workload")
+    parser.add_argument("--extract-latency", type=float, default=0.0, help="seconds the stub model takes per extraction")
+    parser.add_argument("--match-latency", type=float, default=0.0, help="seconds the stub model takes per matching call")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--suppliers", type=int, default=100)
+    parser.add_argument("--master-items", type=int, default=5000)
+    parser.add_argument("--products-per-supplier", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gemini-quota", type=float, help="stub Gemini rejects calls above this many per second with a 429")
+    parser.add_argument("--sheets-quota", type=float, help="fake worksheet rejects calls above this many per second with a 429")
+    parser.add_argument("--no-text-layer", action="store_true", help="skip the local pypdf text-layer path")
+    parser.add_argument("--trace-memory", action="store_true", help="measure peak Python allocations with tracemalloc (slow)")
+    parser.add_argument("-o", "--output", help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.workload == "replay":
+        worksheet, files, responses = replay_workload()
+    else:
+        worksheet, files, responses = synthetic_workload(args.suppliers, args.master_items, args.products_per_supplier, seed=args.seed)
+
+    report = run_pipeline(
+        worksheet, files, responses,
+        extract_latency=args.extract_latency,
+        match_latency=args.match_latency,
+        concurrency=args.concurrency,
+        use_text_layer=not args.no_text_layer,
+        trace_memory=args.trace_memory,
+        gemini_quota=args.gemini_quota,
+        sheets_quota=args.sheets_quota
+    )
+    report["workload"] = args.workload
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+
+from extraction import GeminiExtractionClient
+from fakes import FakeGenAI, FakeWorksheet, StubMatchingModel, recorded_chunks
+from json_stream import iter_products
+from model_sessions import ModelSession
+from pdf_chunks import merge_chunk_results
+from pdf_text import parse_quotation_table, read_text_layer
+from rate_limit import configure_limiter
+from remote_files import RemoteFileRegistry
+from sheets import SheetModel, update_google_sheet_with_multiple_files
+
+# Offline checks of the behaviour the pipeline relies on, driven by the stand-ins in fakes.py.
+# Run: python checks.py [check ...]
+
+def _row(name, quantity, price):
+    return {"name": name, "quantity": quantity, "unit": "ชุด", "pricePerUnit": price, "totalPrice": quantity * price}
+
+def check_chunk_overlap_merge():
+    # Chunks (0,4) and (3,7): page 4 is in both, and the same per-unit row is quoted on page 1 and on page 7
+    drilling = _row("ค่าเจาะรูกระจก", 4, 50)
+    first = {"company": "A", "products": [drilling, _row("กระจกเทมเปอร์ 10 มม.", 2, 1200), _row("ยางซีล", 10, 30)]}
+    second = {"company": None, "products": [_row("ยางซีล", 10, 30), _row("มือจับสแตนเลส", 2, 450), dict(drilling)], "totalPrice": 4000}
+    merged = merge_chunk_results([first, second])
+    names = [product["name"] for product in merged["products"]]
+    assert names == ["ค่าเจาะรูกระจก", "กระจกเทมเปอร์ 10 มม.", "ยางซีล", "มือจับสแตนเลส", "ค่าเจาะรูกระจก"], names
+    assert sum(product["totalPrice"] for product in merged["products"]) == merged["totalPrice"]
+
+def _parse_sample(pattern):
+    with open(glob.glob(pattern)[0], "rb") as f:
+        return parse_quotation_table(read_text_layer(f.read()))
+
+def check_revision_detection():
+    # REV.1 rewords every line of REV.3, so no normalised name is shared, but it is still the same supplier's
+    # quotation: the lines that detected it must also land on the block's rows, for fewer cell writes than a new block
+    configure_limiter("sheets", requests_per_minute=0)
+    old = _parse_sample("DataPDF/level2/old/REV.3*.pdf")
+    new = _parse_sample("DataPDF/level2/new/REV.1*.pdf")
+    fresh = FakeWorksheet()
+    update_google_sheet_with_multiple_files(fresh, [new], llm_match=StubMatchingModel())
+
+    worksheet = FakeWorksheet()
+    update_google_sheet_with_multiple_files(worksheet, [old], llm_match=StubMatchingModel())
+    written = worksheet.cells_written
+    stats = {}
+    update_google_sheet_with_multiple_files(worksheet, [new], match_stats=stats, llm_match=StubMatchingModel())
+    stats = stats[0]
+    assert stats.get("revision") == "C", stats
+    assert stats["matched"] == len(old["products"]) - stats["removed"] and stats["removed"] <= 1, stats
+    assert stats["new"] == len(new["products"]) - stats["matched"], stats
+    assert stats["cells"] == worksheet.cells_written - written < fresh.cells_written, (stats, fresh.cells_written)
+
+    # Revising a block written earlier in the same run counts the cells the same way
+    stats = {}
+    update_google_sheet_with_multiple_files(FakeWorksheet(), [old, new], match_stats=stats, llm_match=StubMatchingModel())
+    assert stats[1].get("revision") == "C" and 0 < stats[1]["cells"] < fresh.cells_written, stats
+
+def check_prompt_prefix_sent_once():
+    # Callers still send "instructions + document"; with context caching the instructions go over the wire only
+    # when the cache is created
+    instructions = "Extract the quotation as JSON with company, products and totals."
+    genai = FakeGenAI()
+    session = ModelSession(instructions, "fake-model", use_cache=True, genai_module=genai)
+    for i in range(6):
+        session.generate_content([f"{instructions}\n\nDocument {i}"])
+    assert session.mode == "cached", session.cache_error
+    assert genai.prefix_transmissions(instructions) == 1, genai.transmissions
+    assert sum(call == "generate_content" for call, _ in genai.transmissions) == 6
+
+def check_stream_parser_chunk_splits():
+    # Chunk boundaries may fall inside strings, escapes and Thai characters; every split must give the same products
+    products = [_row('ราวกันตก "ชั้น 2" \\ ลอย {1}', 2, 1500), _row("ยางซีล, [สีดำ]", 10, 30), _row("มือจับ}", 1, 450)]
+    text = "```json\n" + json.dumps({"company": "A", "products": products, "totalPrice": 3750}, ensure_ascii=False, indent=1) + "\n```"
+    assert list(iter_products(recorded_chunks(text, 1))) == products
+    rng = random.Random(0)
+    for _ in range(300):
+        cuts = sorted(rng.sample(range(1, len(text)), rng.randint(1, 30)))
+        chunks = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+        assert list(iter_products(chunks)) == products, chunks
+
+def check_flush_writes_changed_cells():
+    # Values equal to what the sheet already shows (numbers included) are not written; the rest go in one call
+    configure_limiter("sheets", requests_per_minute=0)
+    worksheet = FakeWorksheet([["", "", "", "บริษัท A"], ["", "", "", "1,200.50", "ชุด"]])
+    sheet = SheetModel(worksheet)
+    sheet.set(1, 4, "บริษัท A")
+    sheet.set(2, 4, 1200.5)
+    sheet.set_row(2, 5, ["ชุด", 3])
+    sheet.set(4, 1, "ยางซีล")
+    assert sheet.flush() == 2
+    assert worksheet.calls == {"get_all_values": 1, "col_values": 0, "row_values": 0, "batch_update": 1}, worksheet.calls
+    assert worksheet.cells_written == 2 and worksheet.rows[1][5] == "3" and worksheet.rows[3][0] == "ยางซีล"
+    assert sheet.flush() == 0 and worksheet.calls["batch_update"] == 1
+
+def check_deleted_upload_sent_again():
+    # Another process purged the upload the registry still lists; the request uploads the file again instead of failing
+    genai = FakeGenAI(reply='{"company": "A", "products": []}')
+    files = RemoteFileRegistry(path=os.path.join(tempfile.mkdtemp(), "remote_files.json"), genai_module=genai)
+    session = ModelSession("Extract the quotation.", "fake-model", genai_module=genai)
+    client = GeminiExtractionClient(prompt="Extract the quotation.", structured_output=False, session=session, files=files)
+    client.extract("a.pdf", b"%PDF-1.4")
+    genai.delete_file(next(iter(files._load().values()))["name"])
+    assert json.loads(client.extract("a.pdf", b"%PDF-1.4"))["company"] == "A"
+    assert len(genai.uploaded) == 2, genai.uploaded
+    assert json.loads(client.extract("a.pdf", b"%PDF-1.4"))["company"] == "A" and len(genai.uploaded) == 2
+
+CHECKS = {
+    "chunk_overlap_merge": check_chunk_overlap_merge,
+    "revision_detection": check_revision_detection,
+    "prompt_prefix_sent_once": check_prompt_prefix_sent_once,
+    "stream_parser_chunk_splits": check_stream_parser_chunk_splits,
+    "flush_writes_changed_cells": check_flush_writes_changed_cells,
+    "deleted_upload_sent_again": check_deleted_upload_sent_again,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline checks")
+    parser.add_argument("checks", nargs="*", help=f"checks to run (default: all): {', '.join(CHECKS)}")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown check(s): {', '.join(unknown)}")
+
+    failed = 0
+    for name in args.checks or CHECKS:
+        try:
+            CHECKS[name]()
+            print(f"ok    {name}")
+        except AssertionError as e:
+            failed += 1
+            print(f"FAIL  {name}: {e}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
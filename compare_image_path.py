@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import time
+
+import metrics
+from batch_extract import find_pdfs
+from extraction import GeminiExtractionClient, parse_response
+from page_images import plan_images
+
+# Compares uploading scanned PDFs as they are with sending their pages as rendered images, per document:
+# bytes sent, render time and end-to-end latency, and whether both paths extract the same products and totals.
+# --offline only renders (no API calls) and reports bytes and render time.
+
+def _percent_saved(before, after):
+    return round(100.0 * (before - after) / before, 1) if before else 0.0
+
+def _summary(data):
+    if not data:
+        return None
+    return {
+        "products": len(data.get("products") or []),
+        "totalPrice": data.get("totalPrice"),
+        "totalPriceIncludeVat": data.get("totalPriceIncludeVat"),
+    }
+
+def compare_document(path, client=None):
+    with open(path, "rb") as f:
+        file_bytes = f.read()
+    file_name = os.path.basename(path)
+
+    started = time.perf_counter()
+    images = plan_images(file_bytes)
+    render_seconds = time.perf_counter() - started
+    if images is None:
+        return None
+    row = {
+        "document": path,
+        "pdf_bytes": len(file_bytes),
+        "image_pages": images["image_pages"],
+        "image_path_bytes": images["upload_bytes"],
+        "bytes_saved_percent": _percent_saved(len(file_bytes), images["upload_bytes"]),
+        "render_seconds": round(render_seconds, 3),
+    }
+    if client is None:
+        return row
+
+    metrics.start_run(enabled=True)
+    started = time.perf_counter()
+    pdf_data = parse_response(client, client.extract(file_name, file_bytes))
+    pdf_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    image_data = parse_response(client, client.extract_images(file_name, images["page_parts"]))
+    # Rendering is part of the image path's end-to-end time
+    image_seconds = time.perf_counter() - started + render_seconds
+    row.update({
+        "pdf_seconds": round(pdf_seconds, 3),
+        "image_seconds": round(image_seconds, 3),
+        "latency_saved_percent": _percent_saved(pdf_seconds, image_seconds),
+        "pdf_result": _summary(pdf_data),
+        "image_result": _summary(image_data),
+        "same_result": _summary(pdf_data) == _summary(image_data),
+    })
+    return row
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare raw PDF upload with the rendered-image path on scanned quotations")
+    parser.add_argument("inputs", nargs="*", help="PDF directories or globs (default: DataPDF)")
+    parser.add_argument("--offline", action="store_true", help="only render the pages; do not call Gemini")
+    parser.add_argument("-o", "--output", help="also write the comparison to this JSON file")
+    args = parser.parse_args(argv)
+
+    client = None
+    if not args.offline:
+        from dotenv import load_dotenv
+        import google.generativeai as genai
+
+        load_dotenv()
+        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        # The registry would turn the second upload of a file into a reuse, which is not what is being measured
+        client = GeminiExtractionClient()
+        client.files.enabled = False
+
+    rows = [row for row in (compare_document(path, client) for path in find_pdfs(args.inputs or ["DataPDF"])) if row]
+    summary = {
+        "documents": len(rows),
+        "bytes_saved_percent": _percent_saved(sum(row["pdf_bytes"] for row in rows), sum(row["image_path_bytes"] for row in rows)),
+    }
+    if client is not None:
+        summary["latency_saved_percent"] = _percent_saved(sum(row["pdf_seconds"] for row in rows), sum(row["image_seconds"] for row in rows))
+        summary["same_result"] = sum(row["same_result"] for row in rows)
+
+    output = json.dumps({"summary": summary, "documents": rows}, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
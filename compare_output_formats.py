@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import time
+
+import metrics
+from batch_extract import find_pdfs
+from benchmark import load_recorded_outputs
+from extraction import GeminiExtractionClient, parse_response
+from structured_output import compact_document
+
+# Compares the free-form JSON prompt with the structured compact format, per document:
+# output tokens and generation latency against the live API, or output size offline on recorded extractions
+
+def _percent_saved(before, after):
+    return round(100.0 * (before - after) / before, 1) if before else 0.0
+
+def compare_recorded(documents):
+    rows = []
+    for i, document in enumerate(documents):
+        # The free-form prompt gets indented JSON back; the schema-constrained reply is minified
+        verbose = json.dumps(document, ensure_ascii=False, indent=2).encode("utf-8")
+        compact = json.dumps(compact_document(document), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        rows.append({
+            "document": document.get("company") or f"document {i}",
+            "products": len(document.get("products") or []),
+            "verbose_bytes": len(verbose),
+            "compact_bytes": len(compact),
+            "bytes_saved_percent": _percent_saved(len(verbose), len(compact)),
+        })
+    return rows
+
+def _measure(client, file_name, file_bytes):
+    run = metrics.start_run(enabled=True)
+    started = time.perf_counter()
+    data = parse_response(client, client.extract(file_name, file_bytes))
+    seconds = time.perf_counter() - started
+    tokens = run.tokens.get("extraction", {})
+    return {
+        "seconds": round(seconds, 3),
+        "generate_seconds": round(run.spans.get("generate_content", {}).get("seconds", 0.0), 3),
+        "prompt_tokens": tokens.get("prompt", 0),
+        "output_tokens": tokens.get("response", 0),
+        "products": len(data.get("products") or []) if data else None,
+    }
+
+def compare_live(paths):
+    free_form = GeminiExtractionClient(structured_output=False)
+    structured = GeminiExtractionClient(structured_output=True)
+    rows = []
+    for path in paths:
+        with open(path, "rb") as f:
+            file_bytes = f.read()
+        file_name = os.path.basename(path)
+        before = _measure(free_form, file_name, file_bytes)
+        after = _measure(structured, file_name, file_bytes)
+        rows.append({
+            "document": path,
+            "free_form": before,
+            "structured": after,
+            "output_tokens_saved_percent": _percent_saved(before["output_tokens"], after["output_tokens"]),
+            "latency_saved_percent": _percent_saved(before["generate_seconds"], after["generate_seconds"]),
+            "same_product_count": before["products"] == after["products"],
+        })
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare free-form and structured compact extraction output per document")
+    parser.add_argument("inputs", nargs="*", help="PDF directories or globs for the live comparison")
+    parser.add_argument("--offline", action="store_true", help="compare output sizes on the recorded extractions instead of calling Gemini")
+    parser.add_argument("-o", "--output", help="also write the comparison to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.offline:
+        rows = compare_recorded(load_recorded_outputs())
+        total_before = sum(row["verbose_bytes"] for row in rows)
+        total_after = sum(row["compact_bytes"] for row in rows)
+        summary = {"documents": len(rows), "bytes_saved_percent": _percent_saved(total_before, total_after)}
+    else:
+        from dotenv import load_dotenv
+        import google.generativeai as genai
+
+        load_dotenv()
+        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+        rows = compare_live(find_pdfs(args.inputs or ["DataPDF"]))
+        summary = {
+            "documents": len(rows),
+            "output_tokens_saved_percent": _percent_saved(
+                sum(row["free_form"]["output_tokens"] for row in rows), sum(row["structured"]["output_tokens"] for row in rows)
+            ),
+            "latency_saved_percent": _percent_saved(
+                sum(row["free_form"]["generate_seconds"] for row in rows), sum(row["structured"]["generate_seconds"] for row in rows)
+            ),
+        }
+
+    output = json.dumps({"summary": summary, "documents": rows}, indent=2, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import json
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from extraction_cache import make_cache_key
+from json_stream import ProductStreamParser
+from model_sessions import get_session
+from page_images import IMAGE_PATH_ENABLED, MAX_INLINE_BYTES, build_image_contents, plan_images
+from pdf_chunks import CHUNK_MIN_PAGES, chunk_prompt, count_pages, extract_chunks, page_ranges, split_pdf
+from pdf_text import TEXT_PATH_ENABLED, build_text_prompt, plan_extraction
+from rate_limit import status_code
+from remote_files import get_registry
+from structured_output import STRUCTURED_OUTPUT_ENABLED, compact_prompt, expand_document, expand_product, extraction_generation_config
+
+MODEL_NAME = "gemini-2.5-flash"
+EXTRACTION_CONCURRENCY = int(os.getenv("EXTRACTION_CONCURRENCY", "4"))
+
+prompt = """# System Message for Product List Extraction (PDF/Text Table Processing)
+
+## Input Format
+Provide PDF files (or images/tables with text extraction) containing product information (receipts, invoices, product lists, etc.):
+* Upload PDF files or images directly
+* Text will be extracted automatically
+* Source should contain clear product details in readable text
+
+## Task
+Analyze the extracted text from documents and extract ALL product information to create a comprehensive product summary list.
+Do not skip any products – ensure complete extraction of every line item, including physical consumables, product accessories, and items such as "ค่าเจาะรูกระจก" if they are charged per unit.
+
+## CRITICAL: Complete Product Collection Rule
+Extract ALL products as individual entries - quotations typically contain unique, detailed specifications.
+- Each line item in the quotation represents a distinct product with specific details
+- DO NOT consolidate or merge products - preserve all individual entries exactly as listed
+- Products in quotations are already unique due to detailed specifications (sizes, locations, materials, etc.)
+- Extract every single row/line item that has quantity, unit price, and total price
+- Maintain the exact product descriptions including all specifications and location details
+
+## Output Format (JSON only)
+You must return ONLY this JSON structure:
+{
+  "company": "company name or first name + last name (NEVER null)",
+  "vat": true,
+  "name": "customer name or null",
+  "contact": "phone number or email or null",
+  "priceGuaranteeDay": 0,
+  "products": [
+    {
+      "name": "full product description in Thai including all specifications AND size (EXCLUDE quantity/unit/price)",
+      "quantity": 1,
+      "unit": "match the unit shown in the pricePerUnit column (e.g., แผ่น, ตร.ม., ชิ้น, ตัว, เมตร, ชุด)",
+      "pricePerUnit": 0,
+      "totalPrice": 0
+    }
+  ],
+  "totalPrice": 0,
+  "totalVat": 0,
+  "totalPriceIncludeVat": 0
+}
+
+## Field Extraction Guidelines
+
+### name (Product Description)
+* Include: material, model/type, size/dimensions, technical specs, finish, location details
+* Include: ALL distinguishing characteristics that make each product unique
+* Exclude: quantity, unit, price
+* Preserve detailed specifications exactly as shown in quotation (sizes, locations, installation details)
+* Example: "งานกระจกบานใส กระจกเทมเปอร์ เปรย์ เกร์ 10 มม. ฝังตัวยูเหล็ก สีเทา บันได ชั้น 1-2 ขนาด 0.975x4.672 ม."
+* For items like "ค่าเจาะรูกระจก กว้าง 16มม.", include all distinguishing attributes in name
+
+### unit and quantity (DIRECT EXTRACTION RULE)
+* Extract unit and quantity DIRECTLY from each line item as shown
+* Use the exact unit shown in the quotation (ชุด, แผ่น, ตร.ม., ชิ้น, ตัว, เมตร, etc.)
+* Each line item represents a separate product entry - extract as individual entries
+* If an item is priced per unit and has physical/product characteristics, treat as a product and include
+
+### pricePerUnit and totalPrice
+* If the document shows both product/material cost (ค่าวัสดุ) and labor/service cost (ค่าแรง) in the same row, always add the two (pricePerUnit = product per unit + service per unit)
+* totalPrice must be calculated as: quantity × pricePerUnit
+* Use numeric values only (no currency symbols)
+* Extract cleanly from pricing fields as shown in each line item
+* Allow minor rounding errors if visible in the document
+* Extract each line item separately - do not combine or consolidate pricing
+* If the quote has discount items, select only the discounted price
+
+### CRITICAL: summaryItems and pricing summaries
+* Extract ALL pricing summary items found at the end of the document into the summaryItems array
+* Each summaryItem must have both a "label" and a "value" field
+* Common labels to look for (extract EXACTLY as shown in document):
+  - "รวม", "รวมเป็นเงิน", "ราคารวม", "Total", "TOTAL AMOUNT", "รวมราคา" - the initial subtotal
+  - "ภาษีมูลค่าเพิ่ม 7%", "VAT 7%" - the VAT amount
+  - "ค่าดำเนินการ 10%", "ค่าดำเนินการกำไร 12%", "Operating fee" - administrative fees
+  - "ยอดรวมทั้งสิ้น", "รวมทั้งหมด", "รวมเงินทั้งสิน", "ราคารวมสุทธิ", "รวมราคางานทั้งหมดตามสัญญา", "TOTAL AMOUNT OF TENDER (INCLUDING VAT)" - the final total
+* Extract the numeric values from each summary item exactly as shown (remove any commas, currency symbols)
+* IMPORTANT: Also populate these specific fields:
+  - totalPrice: Use the value from label matching "รวม", "รวมเป็นเงิน", "ราคารวม", "Total", etc. (subtotal before VAT)
+  - totalVat: Use the value from label matching "ภาษีมูลค่าเพิ่ม 7%", "VAT 7%"
+  - totalPriceIncludeVat: Use the value from label matching "ยอดรวมทั้งสิ้น", "รวมทั้งหมด", "รวมราคางานทั้งหมดตามสัญญา", etc. (final total)
+* CRITICAL: All labels and numeric values must be extracted EXACTLY as shown in the document
+
+## Complete Product Extraction Algorithm
+1. Identify all line items with product descriptions, quantities, and prices
+2. Extract each line item as a separate product - do not group or consolidate
+3. Preserve all specifications and distinguishing details in the product name
+4. Include location/installation details that make each product unique
+5. Maintain individual quantities and pricing exactly as shown in quotation
+
+## Inclusion/Exclusion Rules
+* Extract ALL physical products and ALL items with price per unit, including consumables, parts, and accessories
+* Include "ค่าเจาะรูกระจก" and similar items IF they are presented as a per-unit/consumable/physical item in the product table
+* Exclude service/labor cost lines without a per-unit count (e.g., lump sum services)
+* Each line item with specifications = separate product entry - preserve all individual entries
+* Include all location-specific variations (different floors, units, areas) as separate products
+
+## Quality Assurance Checklist
+- [ ] ALL line items with products, quantities, and prices extracted
+- [ ] Each product entry preserves detailed specifications and location details
+- [ ] Product names include all distinguishing characteristics
+- [ ] Quantities and prices match exactly what's shown in quotation
+- [ ] No line items missed - complete extraction achieved
+- [ ] All summaryItems accurately captured with exact labels and values
+- [ ] totalPrice, totalVat, and totalPriceIncludeVat correctly mapped to appropriate summary values
+
+## Final Notes
+* PRIMARY GOAL: Extract every single product line item - quotations contain unique, detailed specifications
+* Extract all line items meeting the above rules - preserve each as individual product entry
+* Include all specs, sizes, and location details in name for complete product identification
+* Match unit and quantity with pricePerUnit exactly as shown in quotation
+* Maintain complete fidelity to the original quotation structure and details
+* If the quote has discount items, select only the discounted price
+* Ensure ALL summary pricing items are captured with exact labels and values
+"""
+
+def extract_json_from_text(text):
+    start_idx = text.find('{')
+    end_idx = text.rfind('}') + 1
+    if start_idx >= 0 and end_idx > start_idx:
+        return json.loads(text[start_idx:end_idx])
+    return None
+
+def parse_response(client, text):
+    # Clients in structured-output mode return schema-constrained compact JSON; everything else is free-form text
+    if getattr(client, "structured_output", False):
+        return expand_document(json.loads(text))
+    return extract_json_from_text(text)
+
+class GeminiExtractionClient:
+    def __init__(self, prompt=prompt, model_name=MODEL_NAME, structured_output=STRUCTURED_OUTPUT_ENABLED, session=None, files=None):
+        self.structured_output = structured_output
+        self.prompt = compact_prompt(prompt) if structured_output else prompt
+        self.model_name = model_name
+        self.generation_config = extraction_generation_config() if structured_output else None
+        # The prompt lives on the session's model, so requests only carry the document and any per-chunk note
+        self.session = session or get_session(self.prompt, model_name, self.generation_config)
+        self.files = files or get_registry()
+
+    def _upload(self, file_name, file_bytes):
+        return self.files.get_or_upload(file_name, file_bytes)
+
+    def _request(self, build, stream=False):
+        # build() returns the contents. A file_data part refers to an upload the registry remembers, which the
+        # server may have deleted since (by hand, or purge_expired in another process); that shows up as 403/404,
+        # so the entry is dropped and the contents built once more, uploading the file again
+        contents = build()
+        try:
+            return self.session.generate_content(contents, stream=stream)
+        except Exception as e:
+            parts = contents if isinstance(contents, list) else [contents]
+            stale = [part["file_data"]["file_uri"] for part in parts if isinstance(part, dict) and "file_data" in part]
+            if not stale or status_code(e) not in (403, 404):
+                raise
+            for uri in stale:
+                self.files.forget(uri)
+            metrics.add("upload_stale")
+            return self.session.generate_content(build(), stream=stream)
+
+    def _generate(self, build):
+        with metrics.span("generate_content"):
+            response = self._request(build)
+        metrics.record_usage("extraction", response)
+        return response.text
+
+    def _generate_stream(self, build):
+        # The span covers the whole stream, since the model is still generating until the last chunk arrives
+        with metrics.span("generate_content"):
+            response = self._request(build, stream=True)
+            for chunk in response:
+                yield chunk.text
+        metrics.record_usage("extraction", response)
+
+    def extract(self, file_name, file_bytes, prompt=None):
+        return self._generate(lambda: [prompt or self.prompt, self._upload(file_name, file_bytes)])
+
+    def extract_text(self, file_name, text_prompt):
+        return self._generate(lambda: text_prompt)
+
+    def extract_stream(self, file_name, file_bytes, prompt=None):
+        return self._generate_stream(lambda: [prompt or self.prompt, self._upload(file_name, file_bytes)])
+
+    def extract_text_stream(self, file_name, text_prompt):
+        return self._generate_stream(lambda: text_prompt)
+
+    def _image_contents(self, file_name, page_parts, prompt):
+        contents = build_image_contents(prompt or self.prompt, page_parts)
+        if sum(len(part["data"]) for part in contents if isinstance(part, dict)) <= MAX_INLINE_BYTES:
+            return contents
+        return [self._upload_image(file_name, part) if isinstance(part, dict) else part for part in contents]
+
+    def _upload_image(self, file_name, part):
+        return self.files.get_or_upload(file_name, part["data"], mime_type=part["mime_type"])
+
+    def extract_images(self, file_name, page_parts, prompt=None):
+        return self._generate(lambda: self._image_contents(file_name, page_parts, prompt))
+
+    def extract_images_stream(self, file_name, page_parts, prompt=None):
+        return self._generate_stream(lambda: self._image_contents(file_name, page_parts, prompt))
+
+def read_stream(chunks, on_product, structured_output=False):
+    # Hands each product to on_product as soon as it is complete and returns the full response text
+    parser = ProductStreamParser(array_key="p" if structured_output else "products")
+    for chunk in chunks:
+        for product in parser.feed(chunk):
+            on_product(expand_product(product) if structured_output else product)
+    return parser.text
+
+def extract_in_chunks(client, file_name, file_bytes, plan, page_count, ranges):
+    # Long documents are extracted as overlapping page ranges in parallel and merged afterwards
+    if plan["path"] == "text":
+        def extract_chunk(chunk_idx, start, end):
+            text_prompt = build_text_prompt(chunk_prompt(client.prompt, start, end, page_count), plan["page_texts"][start:end], first_page=start + 1)
+            return parse_response(client, client.extract_text(f"{file_name} [pages {start + 1}-{end}]", text_prompt))
+    elif plan["path"] == "images":
+        def extract_chunk(chunk_idx, start, end):
+            response = client.extract_images(f"{file_name} [pages {start + 1}-{end}]", plan["page_parts"][start:end], prompt=chunk_prompt(client.prompt, start, end, page_count))
+            return parse_response(client, response)
+    else:
+        chunk_bytes = split_pdf(file_bytes, ranges)
+
+        def extract_chunk(chunk_idx, start, end):
+            response = client.extract(f"{file_name} [pages {start + 1}-{end}]", chunk_bytes[chunk_idx], prompt=chunk_prompt(client.prompt, start, end, page_count))
+            return parse_response(client, response)
+
+    return extract_chunks(extract_chunk, ranges)
+
+def extract_file(client, file_name, file_bytes, cache=None, use_text_layer=TEXT_PATH_ENABLED, on_product=None, use_images=IMAGE_PATH_ENABLED):
+    info = {"data": None, "cached": False, "path": None, "chunks": 1, "saved_bytes": 0, "saved_tokens": 0}
+    cache_key = None
+    if cache is not None and cache.enabled:
+        cache_key = make_cache_key(file_bytes, client.prompt, client.model_name)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            info.update(data=cached, cached=True, path="cache", saved_bytes=len(file_bytes))
+            if on_product:
+                for product in cached.get("products") or []:
+                    on_product(product)
+            return info
+
+    plan = plan_extraction(file_bytes, client.prompt, enabled=use_text_layer)
+    if plan["path"] == "upload" and use_images:
+        try:
+            images = plan_images(file_bytes, plan["page_texts"], use_text_layer)
+        except Exception:
+            # No poppler, or a page that will not render: the PDF is uploaded as before
+            metrics.add("image_render_errors")
+            images = None
+        if images:
+            plan.update(path="images", page_parts=images["page_parts"], saved_bytes=max(0, len(file_bytes) - images["upload_bytes"]))
+    info.update(path=plan["path"], saved_bytes=plan["saved_bytes"], saved_tokens=plan["saved_tokens"])
+    page_count = plan["pages"]
+    if page_count is None and plan["path"] != "local":
+        try:
+            page_count = count_pages(file_bytes)
+        except Exception:
+            page_count = 0
+
+    streamed = False
+    if plan["path"] == "local":
+        data = plan["data"]
+    elif page_count >= CHUNK_MIN_PAGES:
+        ranges = page_ranges(page_count)
+        info["chunks"] = len(ranges)
+        data = extract_in_chunks(client, file_name, file_bytes, plan, page_count, ranges)
+    elif on_product:
+        if plan["path"] == "text":
+            chunks = client.extract_text_stream(file_name, plan["text_prompt"])
+        elif plan["path"] == "images":
+            chunks = client.extract_images_stream(file_name, plan["page_parts"])
+        else:
+            chunks = client.extract_stream(file_name, file_bytes)
+        structured_output = getattr(client, "structured_output", False)
+        data = parse_response(client, read_stream(chunks, on_product, structured_output))
+        streamed = True
+    elif plan["path"] == "text":
+        data = parse_response(client, client.extract_text(file_name, plan["text_prompt"]))
+    elif plan["path"] == "images":
+        data = parse_response(client, client.extract_images(file_name, plan["page_parts"]))
+    else:
+        data = parse_response(client, client.extract(file_name, file_bytes))
+
+    if on_product and not streamed and data is not None:
+        for product in data.get("products") or []:
+            on_product(product)
+
+    if cache_key is not None and data is not None:
+        cache.put(cache_key, data)
+    info["data"] = data
+    return info
+
+def extract_files_concurrently(files, client, max_workers=EXTRACTION_CONCURRENCY, on_file_done=None, cache=None, use_text_layer=TEXT_PATH_ENABLED, on_product=None, use_images=IMAGE_PATH_ENABLED):
+    # files is a list of (name, bytes); results come back in the same order
+    results = [None] * len(files)
+    if not files:
+        return results
+
+    # Workers report through a queue so every callback runs on the calling thread,
+    # where Streamlit widgets can be updated
+    events = queue.Queue()
+
+    def run(idx, file_name, file_bytes):
+        product_callback = None
+        if on_product:
+            product_callback = lambda product: events.put(("product", idx, product))
+        try:
+            events.put(("done", idx, extract_file(client, file_name, file_bytes, cache, use_text_layer, product_callback, use_images)))
+        except Exception as e:
+            events.put(("error", idx, str(e)))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(files)))) as executor:
+        for idx, (file_name, file_bytes) in enumerate(files):
+            executor.submit(metrics.carry(run), idx, file_name, file_bytes)
+
+        done_count = 0
+        while done_count < len(files):
+            kind, idx, payload = events.get()
+            if kind == "product":
+                on_product(files[idx][0], payload)
+                continue
+
+            result = {"name": files[idx][0], "data": None, "error": None, "cached": False, "path": None, "chunks": 1, "saved_bytes": 0, "saved_tokens": 0}
+            if kind == "error":
+                result["error"] = payload
+            else:
+                result.update(payload)
+                if result["data"] is None:
+                    result["error"] = "No JSON object found in model response"
+            results[idx] = result
+            done_count += 1
+            if on_file_done:
+                on_file_done(result, done_count, len(files))
+
+    return results
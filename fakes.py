@@ -0,0 +1,256 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+# Local stand-ins for the Gemini and Google Sheets clients so the pipeline can be exercised offline
+
+class FakeAPIError(Exception):
+    # Shaped like google.api_core's errors and gspread's APIError: an int code and a message
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+class ThrottledError(FakeAPIError):
+    def __init__(self, message="429 Quota exceeded: Resource has been exhausted (e.g. check quota).", code=429):
+        super().__init__(message, code)
+
+class ThrottleSchedule:
+    # Decides which calls are rejected: explicit call numbers (1-based), every n-th call,
+    # and/or a quota of calls per rolling second
+    def __init__(self, calls=(), every=None, per_second=None, clock=time.monotonic):
+        self.calls = set(calls)
+        self.every = every
+        self.per_second = per_second
+        self.clock = clock
+        self.count = 0
+        self.throttled = 0
+        self._window = []
+        self._lock = threading.Lock()
+
+    def check(self):
+        with self._lock:
+            self.count += 1
+            now = self.clock()
+            self._window = [t for t in self._window if now - t < 1.0]
+            throttled = (
+                self.count in self.calls
+                or (self.every is not None and self.count % self.every == 0)
+                or (self.per_second is not None and len(self._window) >= self.per_second)
+            )
+            if throttled:
+                self.throttled += 1
+            else:
+                self._window.append(now)
+        if throttled:
+            raise ThrottledError()
+
+class StubExtractionClient:
+    def __init__(self, responses, latency=0.0, failures=None, prompt="stub prompt", model_name="stub-model", stream_chunk_size=64, throttle=None):
+        # responses maps file name -> dict (returned as JSON text) or str (returned verbatim)
+        self.responses = responses
+        self.prompt = prompt
+        self.model_name = model_name
+        self.latency = latency
+        self.stream_chunk_size = stream_chunk_size
+        self.failures = failures or {}
+        self.throttle = throttle
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def extract(self, file_name, file_bytes, prompt=None):
+        with self._lock:
+            self.calls.append(file_name)
+        if self.throttle:
+            self.throttle.check()
+        if self.latency:
+            time.sleep(self.latency)
+        if file_name in self.failures:
+            raise self.failures[file_name]
+        # Page-range chunks ("name.pdf [pages 1-4]") may have their own canned response or share the file's
+        response = self.responses.get(file_name)
+        if response is None:
+            response = self.responses[file_name.split(" [pages ")[0]]
+        if isinstance(response, str):
+            return response
+        return json.dumps(response, ensure_ascii=False)
+
+    def extract_text(self, file_name, text_prompt):
+        return self.extract(file_name, text_prompt.encode("utf-8"))
+
+    def extract_stream(self, file_name, file_bytes, prompt=None):
+        # Replays the canned response as a recorded sequence of fixed-size chunks
+        for chunk in recorded_chunks(self.extract(file_name, file_bytes, prompt), self.stream_chunk_size):
+            yield chunk
+
+    def extract_text_stream(self, file_name, text_prompt):
+        return self.extract_stream(file_name, text_prompt.encode("utf-8"))
+
+    def extract_images(self, file_name, page_parts, prompt=None):
+        return self.extract(file_name, b"", prompt)
+
+    def extract_images_stream(self, file_name, page_parts, prompt=None):
+        return self.extract_stream(file_name, b"", prompt)
+
+def recorded_chunks(text, chunk_size):
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+def _column_index(letters):
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index
+
+def _parse_cell(cell):
+    letters = "".join(ch for ch in cell if ch.isalpha())
+    return int(cell[len(letters):]), _column_index(letters)
+
+class FakeWorksheet:
+    # Implements the gspread Worksheet calls the app uses and counts each one as an API round trip
+    def __init__(self, rows=None, throttle=None):
+        self.rows = [list(row) for row in (rows or [])]
+        self.throttle = throttle
+        self.calls = {"get_all_values": 0, "col_values": 0, "row_values": 0, "batch_update": 0}
+        self.cells_written = 0
+
+    @property
+    def call_count(self):
+        return sum(self.calls.values())
+
+    def get_all_values(self):
+        self.calls["get_all_values"] += 1
+        if self.throttle:
+            self.throttle.check()
+        width = max((len(row) for row in self.rows), default=0)
+        return [row + [""] * (width - len(row)) for row in self.rows]
+
+    def row_values(self, row):
+        self.calls["row_values"] += 1
+        values = list(self.rows[row - 1]) if row <= len(self.rows) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def col_values(self, col):
+        self.calls["col_values"] += 1
+        values = [row[col - 1] if col <= len(row) else "" for row in self.rows]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def batch_update(self, data, value_input_option=None):
+        self.calls["batch_update"] += 1
+        if self.throttle:
+            self.throttle.check()
+        for update in data:
+            start, _, _ = update["range"].partition(":")
+            start_row, start_col = _parse_cell(start)
+            for row_offset, values in enumerate(update["values"]):
+                for col_offset, value in enumerate(values):
+                    self._write(start_row + row_offset, start_col + col_offset, value)
+
+    def _write(self, row, col, value):
+        if len(self.rows) < row:
+            self.rows.extend([] for _ in range(row - len(self.rows)))
+        if len(self.rows[row - 1]) < col:
+            self.rows[row - 1].extend([""] * (col - len(self.rows[row - 1])))
+        self.rows[row - 1][col - 1] = "" if value is None else str(value)
+        self.cells_written += 1
+
+class StubMatchingModel:
+    # Stands in for match_products_with_gemini: answers "no match" for every item after a fixed latency
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, list_a, list_b):
+        with self._lock:
+            self.calls += 1
+            self.items += len(list_b)
+        if self.latency:
+            time.sleep(self.latency)
+        return [-1] * len(list_b)
+
+class _FakeResponse:
+    def __init__(self, text, prompt_chars, cached_chars):
+        self.text = text
+        # Rough token counts (4 characters per token), enough to compare requests with each other
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=(prompt_chars + cached_chars) // 4,
+            cached_content_token_count=cached_chars // 4,
+            candidates_token_count=len(text) // 4,
+            total_token_count=(prompt_chars + cached_chars + len(text)) // 4
+        )
+
+    def __iter__(self):
+        for chunk in recorded_chunks(self.text, 64):
+            yield SimpleNamespace(text=chunk)
+
+class _FakeGenerativeModel:
+    genai = None
+
+    def __init__(self, model_name=None, system_instruction=None, generation_config=None, cached_content=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.generation_config = generation_config
+        self.cached_content = cached_content
+        self.genai.models_built += 1
+
+    @classmethod
+    def from_cached_content(cls, cached_content, generation_config=None):
+        return cls(model_name=cached_content.model, generation_config=generation_config, cached_content=cached_content)
+
+    def generate_content(self, contents, generation_config=None, stream=False):
+        parts = contents if isinstance(contents, list) else [contents]
+        for part in parts:
+            # The Files API answers 403 for a reference to an upload that has been deleted
+            if isinstance(part, dict) and "file_data" in part and any(part["file_data"]["file_uri"].endswith(f"/{name}") for name in self.genai.deleted):
+                raise FakeAPIError("403 You do not have permission to access the File or it may not exist.", 403)
+        texts = [part for part in parts if isinstance(part, str)]
+        # A system_instruction travels with every request; cached context is referenced by name only
+        if self.cached_content is None and self.system_instruction:
+            texts.insert(0, self.system_instruction)
+        self.genai.record("generate_content", texts)
+        cached_chars = len(self.cached_content.system_instruction) if self.cached_content is not None else 0
+        return _FakeResponse(self.genai.reply, sum(len(text) for text in texts), cached_chars)
+
+class FakeGenAI:
+    # Stands in for the google.generativeai module behind model_sessions.ModelSession and records every text
+    # that would go over the wire, so tests can check the static prompt prefix is only transmitted once
+    def __init__(self, reply="{}", caching_available=True):
+        self.reply = reply
+        self.caching_available = caching_available
+        self.models_built = 0
+        self.transmissions = []
+        self.uploaded = []
+        self.deleted = []
+        self._lock = threading.Lock()
+        self.GenerativeModel = type("GenerativeModel", (_FakeGenerativeModel,), {"genai": self})
+        self.caching = SimpleNamespace(CachedContent=SimpleNamespace(create=self._create_cache))
+
+    def record(self, call, texts):
+        with self._lock:
+            self.transmissions.append((call, list(texts)))
+
+    def _create_cache(self, model, system_instruction=None, ttl=None, **kwargs):
+        if not self.caching_available:
+            raise FakeAPIError("400 Cached content is too small or caching is not supported for this model", 400)
+        self.record("create_cache", [system_instruction])
+        return SimpleNamespace(name=f"cachedContents/{len(self.transmissions)}", model=model, system_instruction=system_instruction)
+
+    def upload_file(self, path, mime_type=None, display_name=None, **kwargs):
+        data = path.read() if hasattr(path, "read") else open(path, "rb").read()
+        with self._lock:
+            self.uploaded.append(len(data))
+            name = f"files/upload-{len(self.uploaded)}"
+        return SimpleNamespace(name=name, uri=f"https://generativelanguage.googleapis.com/v1beta/{name}", mime_type=mime_type, display_name=display_name)
+
+    def delete_file(self, name):
+        with self._lock:
+            self.deleted.append(name)
+
+    def prefix_transmissions(self, prefix):
+        # Number of calls that carried the prefix, whether as a system instruction, cached context or inline prompt
+        return sum(any(text.startswith(prefix) for text in texts) for _, texts in self.transmissions)
@@ -0,0 +1,226 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from product_matcher import normalize_product_name
+
+# Append-only SQLite history of every extracted line item, indexed for price-history and supplier-comparison
+# queries. Rows are only ever inserted; a document (by content hash) is recorded once.
+
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "history.sqlite3")
+HISTORY_DISABLED = os.getenv("HISTORY_DISABLED", "").lower() in ("1", "true", "yes")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    doc_hash TEXT NOT NULL UNIQUE,
+    supplier TEXT NOT NULL,
+    file_name TEXT,
+    recorded_at REAL NOT NULL,
+    total_price REAL,
+    total_vat REAL,
+    total_price_include_vat REAL
+);
+CREATE TABLE IF NOT EXISTS line_items (
+    id INTEGER PRIMARY KEY,
+    document_id INTEGER NOT NULL REFERENCES documents(id),
+    supplier TEXT NOT NULL,
+    doc_hash TEXT NOT NULL,
+    product_key TEXT NOT NULL,
+    product_name TEXT,
+    quantity REAL,
+    unit TEXT,
+    unit_price REAL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS line_items_product_time ON line_items(product_key, recorded_at);
+CREATE INDEX IF NOT EXISTS line_items_supplier_product ON line_items(supplier, product_key, recorded_at);
+CREATE INDEX IF NOT EXISTS line_items_doc_hash ON line_items(doc_hash);
+CREATE INDEX IF NOT EXISTS line_items_recorded_at ON line_items(recorded_at);
+"""
+
+# Trigram index over product keys, so "contains" searches on Thai descriptions do not scan the whole table
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS line_items_fts USING fts5(product_key, content='line_items', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS line_items_fts_insert AFTER INSERT ON line_items BEGIN
+    INSERT INTO line_items_fts(rowid, product_key) VALUES (new.id, new.product_key);
+END;
+"""
+
+def _number(value):
+    try:
+        return float(str(value).replace(",", ""))
+    except (TypeError, ValueError):
+        return None
+
+def _timestamp(value):
+    # Accepts epoch seconds, datetime/date objects or ISO date strings ("2025-01-31")
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return value.timestamp()
+
+class HistoryStore:
+    def __init__(self, path=HISTORY_DB_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            try:
+                conn.executescript(FTS_SCHEMA)
+                self.has_fts = True
+            except sqlite3.OperationalError:
+                # SQLite builds without FTS5 or the trigram tokenizer fall back to LIKE scans
+                self.has_fts = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def record_document(self, data, file_bytes=None, file_name=None, doc_hash=None, recorded_at=None):
+        # Returns the number of line items written; 0 when this document was recorded before
+        doc_hash = doc_hash or hashlib.sha256(file_bytes if file_bytes is not None else json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        recorded_at = _timestamp(recorded_at) or time.time()
+        supplier = (data.get("company") or "").strip()
+        conn = self._connect()
+        try:
+            with conn:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO documents (doc_hash, supplier, file_name, recorded_at, total_price, total_vat, total_price_include_vat) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (doc_hash, supplier, file_name, recorded_at, _number(data.get("totalPrice")), _number(data.get("totalVat")), _number(data.get("totalPriceIncludeVat")))
+                )
+                if cursor.rowcount == 0:
+                    return 0
+                document_id = cursor.lastrowid
+                rows = [
+                    (
+                        document_id, supplier, doc_hash, normalize_product_name(product.get("name") or ""), product.get("name"),
+                        _number(product.get("quantity")), product.get("unit"), _number(product.get("pricePerUnit")), recorded_at
+                    )
+                    for product in data.get("products") or []
+                ]
+                conn.executemany(
+                    "INSERT INTO line_items (document_id, supplier, doc_hash, product_key, product_name, quantity, unit, unit_price, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                return len(rows)
+        finally:
+            conn.close()
+
+    def record_documents(self, documents, files=None):
+        # files[i] is the (name, bytes) pair documents[i] came from; the bytes' hash identifies the document
+        written = 0
+        for i, data in enumerate(documents):
+            file_name, file_bytes = files[i] if files else (None, None)
+            written += self.record_document(data, file_bytes=file_bytes, file_name=file_name)
+        return written
+
+    def _product_filter(self, product, exact):
+        key = normalize_product_name(product)
+        if exact:
+            return "li.product_key = ?", [key]
+        if self.has_fts and len(key) >= 3:
+            phrase = '"' + key.replace('"', '""') + '"'
+            return "li.id IN (SELECT rowid FROM line_items_fts WHERE line_items_fts MATCH ?)", [phrase]
+        return "li.product_key LIKE ? ESCAPE '\\'", ["%" + key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"]
+
+    def _where(self, product, exact, since, until, supplier):
+        clause, params = self._product_filter(product, exact)
+        clauses = [clause]
+        if since is not None:
+            clauses.append("li.recorded_at >= ?")
+            params.append(_timestamp(since))
+        if until is not None:
+            clauses.append("li.recorded_at < ?")
+            params.append(_timestamp(until))
+        if supplier:
+            clauses.append("li.supplier = ?")
+            params.append(supplier)
+        return " AND ".join(clauses), params
+
+    def price_history(self, product, since=None, until=None, supplier=None, exact=False, limit=1000):
+        # Every quote for products whose normalised name contains (or equals, with exact=True) the given text
+        where, params = self._where(product, exact, since, until, supplier)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT li.recorded_at, li.supplier, li.product_name, li.quantity, li.unit, li.unit_price, li.doc_hash "
+                f"FROM line_items li WHERE {where} ORDER BY li.recorded_at DESC LIMIT ?",
+                params + [limit]
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def supplier_comparison(self, product, since=None, until=None, exact=False):
+        # One row per supplier and unit: number of quotes, min/avg/max unit price and the most recent quote
+        where, params = self._where(product, exact, since, until, None)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"""
+                WITH matched AS (
+                    SELECT li.supplier, li.unit, li.unit_price, li.recorded_at,
+                           ROW_NUMBER() OVER (PARTITION BY li.supplier, li.unit ORDER BY li.recorded_at DESC, li.id DESC) AS recency
+                    FROM line_items li WHERE {where} AND li.unit_price IS NOT NULL
+                )
+                SELECT supplier, unit, COUNT(*) AS quotes, MIN(unit_price) AS min_price, AVG(unit_price) AS avg_price,
+                       MAX(unit_price) AS max_price,
+                       MAX(CASE WHEN recency = 1 THEN unit_price END) AS latest_price,
+                       MAX(recorded_at) AS latest_at
+                FROM matched GROUP BY supplier, unit ORDER BY avg_price
+                """,
+                params
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            documents = conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            line_items = conn.execute("SELECT COUNT(*) FROM line_items").fetchone()[0]
+        finally:
+            conn.close()
+        return {"documents": documents, "line_items": line_items}
+
+def _format_time(rows):
+    for row in rows:
+        for field in ("recorded_at", "latest_at"):
+            if row.get(field) is not None:
+                row[field] = datetime.datetime.fromtimestamp(row[field]).isoformat(timespec="seconds")
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the line-item price history")
+    parser.add_argument("query", choices=["history", "compare", "stats"])
+    parser.add_argument("product", nargs="?", default="", help="product text, e.g. \"เทมเปอร์ใส 10 มม.\"")
+    parser.add_argument("--since", help="ISO date, e.g. 2025-01-01")
+    parser.add_argument("--until", help="ISO date (exclusive)")
+    parser.add_argument("--supplier")
+    parser.add_argument("--exact", action="store_true", help="match the whole normalised product name")
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--db", default=HISTORY_DB_PATH)
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(args.db)
+    if args.query == "stats":
+        result = store.stats()
+    elif args.query == "history":
+        result = _format_time(store.price_history(args.product, args.since, args.until, args.supplier, args.exact, args.limit))
+    else:
+        result = _format_time(store.supplier_comparison(args.product, args.since, args.until, args.exact))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import metrics
+from extraction import EXTRACTION_CONCURRENCY, extract_file
+from extraction_cache import ExtractionCache, make_cache_key
+from rate_limit import GEMINI_REQUESTS_PER_MINUTE, configure_limiter
+
+# Persistent extraction queue. The UI (or any other producer) submits files and polls; worker threads claim
+# jobs from SQLite, so a browser refresh or rerun does not stop them and a restarted process picks up where
+# the last one stopped. All workers in a process share one client, and with it one rate limiter. Each job's
+# timings, tokens and uploads are stored with it, so whoever applies a batch reports that batch's own numbers.
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(EXTRACTION_CONCURRENCY)))
+# Processes running workers against the same API key, the app included; each takes an equal share of the quota
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "1"))
+# A running job whose worker has not reported within this time is handed to another worker
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "900"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# A batch whose results are being written is left alone by other tabs for this long, unless the writer finishes
+# or gives up first
+APPLY_LEASE_SECONDS = int(os.getenv("JOB_APPLY_LEASE_SECONDS", "300"))
+# Finished jobs and batches older than this are deleted; a finished job's file is dropped as soon as no unapplied
+# batch still needs it
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# Streamed products are saved at most this often, so polling shows them without a write per product
+PARTIAL_WRITE_SECONDS = 0.5
+
+FINISHED = ("done", "failed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    dedup_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    file_bytes BLOB NOT NULL,
+    options TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_expires_at REAL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    partial TEXT,
+    result TEXT,
+    metrics TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs(dedup_key, status);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    settings TEXT,
+    attachment BLOB,
+    documents TEXT,
+    applying_until REAL,
+    applied_at REAL
+);
+CREATE TABLE IF NOT EXISTS batch_jobs (
+    batch_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    job_id TEXT NOT NULL,
+    PRIMARY KEY (batch_id, position)
+);
+"""
+
+# Columns added since the first release, for databases created before them
+MIGRATIONS = {"jobs": [("metrics", "TEXT")], "batches": [("documents", "TEXT"), ("applying_until", "REAL")]}
+
+JOB_FIELDS = "id, status, file_name, options, created_at, started_at, finished_at, worker, attempts, partial, result, metrics, error"
+
+def dedup_key(file_bytes, options, prompt="", model_name=""):
+    # Same inputs as the extraction cache key, so a job is only shared with one that would give the same answer
+    return hashlib.sha256((make_cache_key(file_bytes, prompt, model_name) + json.dumps(options, sort_keys=True)).encode("utf-8")).hexdigest()
+
+def _job(row):
+    job = dict(row)
+    for field in ("options", "partial", "result", "metrics"):
+        job[field] = json.loads(job[field]) if job.get(field) else None
+    return job
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists but belongs to someone else
+        return True
+    return True
+
+class JobQueue:
+    def __init__(self, path=JOB_QUEUE_PATH, clock=time.time):
+        self.path = path
+        self.clock = clock
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+            for table, columns in MIGRATIONS.items():
+                existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+                for column, column_type in columns:
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Autocommit mode, so claims can take the write lock up front with BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _write(self, fn):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                value = fn(conn)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return value
+        finally:
+            conn.close()
+
+    def _submit(self, conn, file_name, file_bytes, options, prompt, model_name):
+        # An identical file with identical options, prompt and model that is queued or running is shared instead of
+        # run twice. Finished results are reused through the extraction cache, which expires them and can be bypassed
+        key = dedup_key(file_bytes, options, prompt, model_name)
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running') ORDER BY created_at DESC LIMIT 1", (key,)
+        ).fetchone()
+        if row:
+            return row["id"], False
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO jobs (id, dedup_key, status, file_name, file_bytes, options, created_at) VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+            (job_id, key, file_name, file_bytes, json.dumps(options, sort_keys=True), self.clock())
+        )
+        return job_id, True
+
+    def submit(self, file_name, file_bytes, options=None, prompt="", model_name=""):
+        job_id, _ = self._write(lambda conn: self._submit(conn, file_name, file_bytes, options or {}, prompt, model_name))
+        return job_id
+
+    def submit_batch(self, files, options=None, settings=None, attachment=None, prompt="", model_name=""):
+        # files is a list of (name, bytes); the batch keeps their order for whoever applies the results
+        def submit_all(conn):
+            batch_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO batches (id, created_at, settings, attachment) VALUES (?, ?, ?, ?)",
+                (batch_id, self.clock(), json.dumps(settings or {}), attachment)
+            )
+            for position, (file_name, file_bytes) in enumerate(files):
+                job_id, _ = self._submit(conn, file_name, file_bytes, options or {}, prompt, model_name)
+                conn.execute("INSERT INTO batch_jobs (batch_id, position, job_id) VALUES (?, ?, ?)", (batch_id, position, job_id))
+            return batch_id
+        return self._write(submit_all)
+
+    def claim(self, worker):
+        # Hands the oldest queued job to this worker; jobs whose lease ran out go back to the queue first
+        def claim_one(conn):
+            now = self.clock()
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'worker stopped responding', finished_at = ? "
+                "WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (now, now, JOB_MAX_ATTEMPTS)
+            )
+            conn.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND lease_expires_at < ?", (now,))
+            row = conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, lease_expires_at = ?, attempts = attempts + 1, partial = NULL WHERE id = ?",
+                (worker, now, now + JOB_LEASE_SECONDS, row["id"])
+            )
+            job = conn.execute(f"SELECT {JOB_FIELDS}, file_bytes FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+            return _job(job)
+        return self._write(claim_one)
+
+    def recover(self, host=None):
+        # Jobs left running by a process on this host that no longer exists are queued again right away
+        host = host or socket.gethostname()
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, worker FROM jobs WHERE status = 'running'").fetchall()
+        finally:
+            conn.close()
+        orphaned = []
+        for row in rows:
+            worker_host, _, rest = (row["worker"] or "").partition(":")
+            pid = rest.partition(":")[0]
+            if worker_host == host and pid.isdigit() and not _alive(int(pid)):
+                orphaned.append(row["id"])
+        if orphaned:
+            self._write(lambda conn: conn.executemany("UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ? AND status = 'running'", [(job_id,) for job_id in orphaned]))
+        return len(orphaned)
+
+    def save_partial(self, job_id, products):
+        # Also renews the lease, since the worker is evidently still making progress
+        now = self.clock()
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET partial = ?, lease_expires_at = ? WHERE id = ? AND status = 'running'",
+            (json.dumps(products, ensure_ascii=False), now + JOB_LEASE_SECONDS, job_id)
+        ))
+
+    def finish(self, job_id, result, error=None, report=None):
+        # report is the job's RunMetrics report
+        status = "failed" if error else "done"
+        self._write(lambda conn: conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, metrics = ?, error = ?, finished_at = ?, lease_expires_at = NULL WHERE id = ?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, json.dumps(report) if report else None, error, self.clock(), job_id)
+        ))
+
+    def job(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT {JOB_FIELDS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return _job(row) if row else None
+
+    def batch(self, batch_id):
+        conn = self._connect()
+        try:
+            batch = conn.execute("SELECT id, created_at, settings, attachment, documents, applying_until, applied_at FROM batches WHERE id = ?", (batch_id,)).fetchone()
+            if batch is None:
+                return None
+            rows = conn.execute(
+                f"SELECT {', '.join('j.' + field.strip() for field in JOB_FIELDS.split(','))} "
+                "FROM batch_jobs b JOIN jobs j ON j.id = b.job_id WHERE b.batch_id = ? ORDER BY b.position",
+                (batch_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        batch = dict(batch)
+        batch["settings"] = json.loads(batch["settings"]) if batch["settings"] else {}
+        batch["documents"] = json.loads(batch["documents"]) if batch["documents"] else None
+        batch["jobs"] = [_job(row) for row in rows]
+        batch["finished"] = all(job["status"] in FINISHED for job in batch["jobs"])
+        return batch
+
+    def batch_files(self, batch_id):
+        # (name, bytes) of every job in the batch, in submission order
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT j.file_name, j.file_bytes FROM batch_jobs b JOIN jobs j ON j.id = b.job_id WHERE b.batch_id = ? ORDER BY b.position",
+                (batch_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [(row["file_name"], row["file_bytes"]) for row in rows]
+
+    def save_documents(self, batch_id, documents):
+        # The validated and re-checked documents, so a retry after a failed write does not check them again
+        self._write(lambda conn: conn.execute(
+            "UPDATE batches SET documents = ? WHERE id = ?", (json.dumps(documents, ensure_ascii=False), batch_id)
+        ))
+
+    def begin_apply(self, batch_id, lease_seconds=APPLY_LEASE_SECONDS):
+        # True for one caller at a time: the batch is not written yet and nobody holds an unexpired lease on it
+        now = self.clock()
+        cursor = self._write(lambda conn: conn.execute(
+            "UPDATE batches SET applying_until = ? WHERE id = ? AND applied_at IS NULL AND (applying_until IS NULL OR applying_until < ?)",
+            (now + lease_seconds, batch_id, now)
+        ))
+        return cursor.rowcount == 1
+
+    def mark_applied(self, batch_id):
+        # Only once the output has been written; until then a stopped writer leaves the batch to be retried
+        cursor = self._write(lambda conn: conn.execute(
+            "UPDATE batches SET applied_at = ?, applying_until = NULL WHERE id = ? AND applied_at IS NULL", (self.clock(), batch_id)
+        ))
+        if cursor.rowcount != 1:
+            return False
+        self.purge()
+        return True
+
+    def release_apply(self, batch_id):
+        self._write(lambda conn: conn.execute("UPDATE batches SET applying_until = NULL WHERE id = ?", (batch_id,)))
+
+    def purge(self, max_age=JOB_RETENTION_SECONDS):
+        # Files and attachments are only read to apply a batch, so they go once no unapplied batch needs them;
+        # batches and finished jobs older than max_age go entirely
+        def purge_all(conn):
+            cutoff = self.clock() - max_age
+            conn.execute("DELETE FROM batch_jobs WHERE batch_id IN (SELECT id FROM batches WHERE created_at < ?)", (cutoff,))
+            conn.execute("DELETE FROM batches WHERE created_at < ?", (cutoff,))
+            jobs = conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND created_at < ? AND id NOT IN (SELECT job_id FROM batch_jobs)", (cutoff,)
+            ).rowcount
+            conn.execute(
+                "UPDATE batches SET attachment = NULL, documents = NULL WHERE applied_at IS NOT NULL AND (attachment IS NOT NULL OR documents IS NOT NULL)"
+            )
+            files = conn.execute(
+                "UPDATE jobs SET file_bytes = X'' WHERE status IN ('done', 'failed') AND length(file_bytes) > 0 AND id NOT IN "
+                "(SELECT b.job_id FROM batch_jobs b JOIN batches s ON s.id = b.batch_id WHERE s.applied_at IS NULL)"
+            ).rowcount
+            return {"jobs_deleted": jobs, "files_dropped": files}
+        return self._write(purge_all)
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT status, COUNT(*) AS jobs FROM jobs GROUP BY status").fetchall()
+        finally:
+            conn.close()
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        counts.update({row["status"]: row["jobs"] for row in rows})
+        return counts
+
+class JobWorker(threading.Thread):
+    def __init__(self, queue, client, name, poll_seconds=JOB_POLL_SECONDS):
+        super().__init__(name=name, daemon=True)
+        self.queue = queue
+        self.client = client
+        self.poll_seconds = poll_seconds
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                job = self.queue.claim(self.name)
+            except sqlite3.OperationalError:
+                # The database is busy or briefly locked; try again on the next poll
+                job = None
+            if job is None:
+                self.stop_event.wait(self.poll_seconds)
+                continue
+            self.process(job)
+
+    def process(self, job):
+        options = job["options"] or {}
+        products = []
+        last_write = [0.0]
+
+        def on_product(product):
+            products.append(product)
+            if time.monotonic() - last_write[0] >= PARTIAL_WRITE_SECONDS:
+                last_write[0] = time.monotonic()
+                self.queue.save_partial(job["id"], products)
+
+        # Workers serve every session, so each job records into its own run rather than the process-wide one
+        run = metrics.RunMetrics(enabled=True)
+        try:
+            with metrics.use_run(run):
+                info = extract_file(
+                    self.client,
+                    job["file_name"],
+                    job["file_bytes"],
+                    ExtractionCache(enabled=options.get("use_cache", True)),
+                    use_text_layer=options.get("use_text_layer", True),
+                    on_product=on_product if options.get("stream_products") else None,
+                    use_images=options.get("use_images", True)
+                )
+        except Exception as e:
+            self.queue.finish(job["id"], None, error=str(e), report=run.report())
+            return
+        self.queue.finish(job["id"], info, error=None if info["data"] else "No JSON object found in model response", report=run.report())
+
+def configure_process_limiter(processes=JOB_PROCESSES):
+    # Each process has its own limiter, so the request quota is split between them as batch_extract does
+    return configure_limiter("gemini", requests_per_minute=GEMINI_REQUESTS_PER_MINUTE / max(1, processes))
+
+def start_workers(queue, client, count=JOB_WORKERS):
+    # Worker names carry host and pid so a restarted process can tell its predecessor's jobs are orphaned
+    queue.recover()
+    queue.purge()
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    workers = [JobWorker(queue, client, f"{prefix}:{i}") for i in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+def stop_workers(workers, timeout=None):
+    for worker in workers:
+        worker.stop_event.set()
+    for worker in workers:
+        worker.join(timeout)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run extraction workers for the job queue, show its status or purge old jobs")
+    parser.add_argument("command", choices=["worker", "status", "purge"])
+    parser.add_argument("-w", "--workers", type=int, default=JOB_WORKERS, help="worker threads in this process")
+    parser.add_argument("-p", "--processes", type=int, default=JOB_PROCESSES, help="processes sharing the API key, the app included")
+    parser.add_argument("--db", default=JOB_QUEUE_PATH)
+    args = parser.parse_args(argv)
+
+    queue = JobQueue(args.db)
+    if args.command == "status":
+        print(json.dumps(queue.stats(), indent=2))
+        return
+    if args.command == "purge":
+        print(json.dumps(queue.purge(), indent=2))
+        return
+
+    from dotenv import load_dotenv
+    import google.generativeai as genai
+
+    from extraction import GeminiExtractionClient
+    from rate_limit import RateLimitedClient
+
+    load_dotenv()
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    workers = start_workers(queue, RateLimitedClient(GeminiExtractionClient(), configure_process_limiter(args.processes)), args.workers)
+    print(f"{len(workers)} worker(s) polling {args.db}")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        stop_workers(workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import json
+
+class ProductStreamParser:
+    # Scans model output as it arrives and emits each element of the top-level "products" array
+    # as soon as its closing brace is seen. Chunk boundaries may fall anywhere, including inside strings.
+    def __init__(self, array_key="products"):
+        self.array_key = array_key
+        self.text = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._array_depth = None
+        self._item_start = None
+        self.emitted = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+        products = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1:
+                        self._last_string = text[self._string_start + 1:i]
+                continue
+
+            if not self._stack and ch != "{":
+                # Prose or code fences before the JSON object
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch in "{[":
+                if (
+                    ch == "[" and self._array_depth is None and len(self._stack) == 1
+                    and self._last_string == self.array_key
+                ):
+                    self._array_depth = len(self._stack) + 1
+                self._stack.append(ch)
+                if ch == "{" and self._array_depth is not None and len(self._stack) == self._array_depth + 1:
+                    self._item_start = i
+            elif ch in "}]":
+                if not self._stack:
+                    continue
+                self._stack.pop()
+                if ch == "}" and self._item_start is not None and len(self._stack) == self._array_depth:
+                    try:
+                        products.append(json.loads(text[self._item_start:i + 1]))
+                        self.emitted += 1
+                    except json.JSONDecodeError:
+                        pass
+                    self._item_start = None
+                elif ch == "]" and self._array_depth is not None and len(self._stack) == self._array_depth - 1:
+                    # Only the first matching array is streamed
+                    self._array_depth = -1
+            elif ch == "," and len(self._stack) == 1:
+                self._last_string = None
+        self._pos = len(text)
+        return products
+
+def iter_products(chunks, parser=None):
+    parser = parser or ProductStreamParser()
+    for chunk in chunks:
+        for product in parser.feed(chunk):
+            yield product
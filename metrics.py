@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv("METRICS_DISABLED", "").lower() not in ("1", "true", "yes")
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")
+METRICS_PREFIX = "pdf_extractor"
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+# Shared by every span() call while metrics are disabled, so a disabled run costs one attribute check per call
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.run.observe(self.name, time.perf_counter() - self.started, failed=exc_type is not None)
+        return False
+
+class RunMetrics:
+    # Timings, token counts and Sheets traffic for one extract-and-update run; safe to use from worker threads
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self.started_at = time.time()
+        self.spans = {}
+        self.tokens = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def observe(self, name, seconds, failed=False):
+        with self._lock:
+            span = self.spans.setdefault(name, {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+            span["count"] += 1
+            span["errors"] += failed
+            span["seconds"] += seconds
+            span["max_seconds"] = max(span["max_seconds"], seconds)
+
+    def add(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_usage(self, stage, response):
+        # usage_metadata is only complete once a streamed response has been fully iterated
+        usage = getattr(response, "usage_metadata", None) if self.enabled else None
+        if usage is None:
+            return
+        with self._lock:
+            tokens = self.tokens.setdefault(stage, {"calls": 0, "prompt": 0, "cached": 0, "response": 0, "total": 0})
+            tokens["calls"] += 1
+            tokens["prompt"] += getattr(usage, "prompt_token_count", 0) or 0
+            tokens["cached"] += getattr(usage, "cached_content_token_count", 0) or 0
+            tokens["response"] += getattr(usage, "candidates_token_count", 0) or 0
+            tokens["total"] += getattr(usage, "total_token_count", 0) or 0
+
+    def merge(self, report):
+        # Adds another run's report, e.g. one recorded by a queue worker for a job of this run
+        with self._lock:
+            for name, other in report.get("spans", {}).items():
+                span = self.spans.setdefault(name, {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0})
+                span["count"] += other["count"]
+                span["errors"] += other["errors"]
+                span["seconds"] += other["seconds"]
+                span["max_seconds"] = max(span["max_seconds"], other["max_seconds"])
+            for stage, other in report.get("tokens", {}).items():
+                tokens = self.tokens.setdefault(stage, {"calls": 0, "prompt": 0, "cached": 0, "response": 0, "total": 0})
+                for field in tokens:
+                    tokens[field] += other.get(field, 0)
+            for name, value in report.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "wall_seconds": round(time.time() - self.started_at, 4),
+                "spans": {
+                    name: dict(span, seconds=round(span["seconds"], 4), max_seconds=round(span["max_seconds"], 4))
+                    for name, span in self.spans.items()
+                },
+                "tokens": {stage: dict(tokens) for stage, tokens in self.tokens.items()},
+                "counters": dict(self.counters),
+            }
+
+    def prometheus_text(self):
+        report = self.report()
+        spans = sorted(report["spans"].items())
+        lines = []
+        # Samples of one metric family have to stay together in the text format
+        for family, kind, field in (
+            ("span_seconds_total", "counter", "seconds"),
+            ("span_calls_total", "counter", "count"),
+            ("span_errors_total", "counter", "errors"),
+            ("span_seconds_max", "gauge", "max_seconds"),
+        ):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{family} {kind}")
+            for name, span in spans:
+                lines.append(f'{METRICS_PREFIX}_{family}{{span="{name}"}} {span[field]}')
+        lines.append(f"# TYPE {METRICS_PREFIX}_tokens_total counter")
+        for stage, tokens in sorted(report["tokens"].items()):
+            for kind in ("prompt", "cached", "response"):
+                lines.append(f'{METRICS_PREFIX}_tokens_total{{stage="{stage}",kind="{kind}"}} {tokens[kind]}')
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name}_total counter")
+            lines.append(f"{METRICS_PREFIX}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory=METRICS_DIR):
+        # One JSON report per run plus metrics.prom, which always holds the latest run (node_exporter textfile format)
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        json_path = os.path.join(directory, f"run-{stamp}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
+        prom_path = os.path.join(directory, "metrics.prom")
+        tmp_path = f"{prom_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, prom_path)
+        return json_path, prom_path
+
+    def summary_lines(self):
+        report = self.report()
+        lines = [
+            f"{name}: {span['count']} call(s), {span['seconds']:.2f}s total, {span['max_seconds']:.2f}s max"
+            for name, span in report["spans"].items()
+        ]
+        for stage, tokens in report["tokens"].items():
+            lines.append(f"{stage} tokens: {tokens['prompt']} prompt ({tokens['cached']} from cache), {tokens['response']} response")
+        counters = report["counters"]
+        if "sheets_reads" in counters or "sheets_writes" in counters:
+            lines.append(
+                f"Sheets: {counters.get('sheets_reads', 0)} read(s) ({counters.get('sheets_read_bytes', 0) / 1024:.1f} KB), "
+                f"{counters.get('sheets_writes', 0)} write(s) ({counters.get('sheets_write_bytes', 0) / 1024:.1f} KB)"
+            )
+        if "upload_bytes" in counters or "upload_reused" in counters:
+            lines.append(
+                f"Uploaded {counters.get('upload_bytes', 0) / 1024:.1f} KB to Gemini, "
+                f"reused {counters.get('upload_reused', 0)} earlier upload(s) ({counters.get('upload_bytes_saved', 0) / 1024:.1f} KB)"
+            )
+        return lines
+
+_current = RunMetrics(enabled=False)
+# Threads that serve several runs at once (queue workers, Streamlit sessions) bind the run they work for
+_bound = threading.local()
+
+def start_run(enabled=METRICS_ENABLED):
+    global _current
+    _current = RunMetrics(enabled=enabled)
+    return _current
+
+def current_run():
+    return getattr(_bound, "run", None) or _current
+
+@contextmanager
+def use_run(run):
+    previous = getattr(_bound, "run", None)
+    _bound.run = run
+    try:
+        yield run
+    finally:
+        _bound.run = previous
+
+def carry(fn):
+    # For work handed to a pool thread: it records into the run of the thread that handed it over
+    run = current_run()
+
+    def call(*args, **kwargs):
+        with use_run(run):
+            return fn(*args, **kwargs)
+    return call
+
+def enabled():
+    return current_run().enabled
+
+def span(name):
+    return current_run().span(name)
+
+def add(name, value=1):
+    current_run().add(name, value)
+
+def record_usage(stage, response):
+    current_run().record_usage(stage, response)
+
+def payload_bytes(values):
+    return len(json.dumps(values, ensure_ascii=False).encode("utf-8"))
@@ -0,0 +1,108 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+
+from rate_limit import status_code
+
+# One long-lived model per static prompt. The static instructions are uploaded once as provider-side cached
+# context when the API allows it, or set as the model's system_instruction otherwise, and each request only
+# carries the per-document payload
+
+CONTEXT_CACHE_DISABLED = os.getenv("CONTEXT_CACHE_DISABLED", "").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# Recreate the cache a little before it expires so no request races the expiry
+CONTEXT_CACHE_REFRESH_MARGIN = 60
+
+class ModelSession:
+    def __init__(self, instructions, model_name, generation_config=None, use_cache=not CONTEXT_CACHE_DISABLED, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS, genai_module=None):
+        self.instructions = instructions
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.use_cache = use_cache
+        self.ttl_seconds = ttl_seconds
+        self.genai = genai_module
+        self.mode = None
+        self.cache_error = None
+        self._model = None
+        self._expires_at = None
+        self._lock = threading.Lock()
+
+    def _genai(self):
+        if self.genai is None:
+            # Imported on first use: the package takes most of a second to import, which delays the first page render
+            import google.generativeai as genai
+            self.genai = genai
+        return self.genai
+
+    def _build(self):
+        genai = self._genai()
+        if self.use_cache:
+            try:
+                cached_content = genai.caching.CachedContent.create(
+                    model=f"models/{self.model_name}",
+                    system_instruction=self.instructions,
+                    ttl=datetime.timedelta(seconds=self.ttl_seconds)
+                )
+                self._expires_at = time.monotonic() + self.ttl_seconds - CONTEXT_CACHE_REFRESH_MARGIN
+                self.mode = "cached"
+                return genai.GenerativeModel.from_cached_content(cached_content=cached_content, generation_config=self.generation_config)
+            except Exception as e:
+                # Prompts below the model's minimum cacheable size, free-tier keys and older models cannot be cached
+                self.cache_error = str(e)
+                self.use_cache = False
+        self._expires_at = None
+        self.mode = "system_instruction"
+        return genai.GenerativeModel(model_name=self.model_name, system_instruction=self.instructions, generation_config=self.generation_config)
+
+    def model(self):
+        with self._lock:
+            if self._model is None or (self._expires_at is not None and time.monotonic() >= self._expires_at):
+                self._model = self._build()
+            return self._model
+
+    def _invalidate(self, model):
+        with self._lock:
+            if self._model is model:
+                self._model = None
+
+    def payload(self, contents):
+        # Callers still build "instructions + document" prompts; the instructions are already on the model, so drop them
+        parts = contents if isinstance(contents, list) else [contents]
+        stripped = []
+        for part in parts:
+            if isinstance(part, str) and part.startswith(self.instructions):
+                part = part[len(self.instructions):].strip()
+                if not part:
+                    continue
+            stripped.append(part)
+        return stripped
+
+    def generate_content(self, contents, stream=False):
+        payload = self.payload(contents)
+        model = self.model()
+        try:
+            return model.generate_content(payload, stream=stream)
+        except Exception as e:
+            # A cache deleted or expired on the server side shows up as 403/404; rebuild once without trusting it
+            if self.mode != "cached" or status_code(e) not in (403, 404):
+                raise
+            self._invalidate(model)
+            return self.model().generate_content(payload, stream=stream)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(instructions, model_name, generation_config=None):
+    # Shared by every client and thread that uses the same static prompt, model and output config
+    key = (
+        model_name,
+        hashlib.sha256(instructions.encode("utf-8")).hexdigest(),
+        json.dumps(generation_config, sort_keys=True, default=str),
+    )
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = ModelSession(instructions, model_name, generation_config)
+        return _sessions[key]
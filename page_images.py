@@ -0,0 +1,120 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from pypdf import PdfReader
+
+import metrics
+from pdf_chunks import split_pdf
+from pdf_text import MIN_PAGE_CHARS, has_usable_text_layer, read_text_layer
+
+# Scanned pages (no text layer) are rendered locally to small grayscale JPEGs and sent inline with the
+# request, instead of uploading the whole PDF. Pages that do have a usable text layer go as text.
+
+IMAGE_PATH_ENABLED = os.getenv("IMAGE_PATH_DISABLED", "").lower() not in ("1", "true", "yes")
+# Long side of the rendered page in pixels; the DPI is chosen per page so A4, Letter and A3 all land near it
+IMAGE_TARGET_PIXELS = int(os.getenv("IMAGE_TARGET_PIXELS", "2000"))
+IMAGE_MIN_DPI = int(os.getenv("IMAGE_MIN_DPI", "100"))
+IMAGE_MAX_DPI = int(os.getenv("IMAGE_MAX_DPI", "300"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "70"))
+IMAGE_RENDER_WORKERS = int(os.getenv("IMAGE_RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Pixels lighter than this count as paper when cropping margins
+MARGIN_THRESHOLD = 235
+MARGIN_PADDING = 16
+# Inline request data is capped at 20 MB; above this the images go through the Files API instead
+MAX_INLINE_BYTES = 15 * 1024 * 1024
+
+def adaptive_dpi(width_points, height_points, target_pixels=IMAGE_TARGET_PIXELS):
+    long_side_inches = max(width_points, height_points) / 72
+    return int(min(IMAGE_MAX_DPI, max(IMAGE_MIN_DPI, target_pixels / long_side_inches)))
+
+def crop_margins(image, threshold=MARGIN_THRESHOLD, padding=MARGIN_PADDING):
+    # Bounding box of everything darker than paper, plus a little padding
+    bbox = image.point(lambda value: 255 if value < threshold else 0).getbbox()
+    if bbox is None:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((max(0, left - padding), max(0, top - padding), min(image.width, right + padding), min(image.height, bottom + padding)))
+
+def render_page(page_bytes, dpi, quality=IMAGE_JPEG_QUALITY):
+    # Runs in a worker process: page_bytes is a single-page PDF
+    from pdf2image import convert_from_bytes
+
+    image = convert_from_bytes(page_bytes, dpi=dpi, grayscale=True)[0]
+    image = crop_margins(image.convert("L"))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+_executor = None
+_executor_lock = threading.Lock()
+_render_workers = IMAGE_RENDER_WORKERS
+
+def configure_renderer(max_workers):
+    # Processes that are already one of many workers (batch_extract) render in-process with max_workers=1
+    global _render_workers
+    _render_workers = max_workers
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # forkserver children do not inherit the app's threads and locks; Windows only has spawn
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _executor = ProcessPoolExecutor(max_workers=_render_workers, mp_context=context)
+        return _executor
+
+def render_pages(file_bytes, pages):
+    # Returns one JPEG per requested page index, in order
+    reader = PdfReader(io.BytesIO(file_bytes))
+    dpis = [adaptive_dpi(float(reader.pages[page].mediabox.width), float(reader.pages[page].mediabox.height)) for page in pages]
+    page_pdfs = split_pdf(file_bytes, [(page, page + 1) for page in pages])
+    with metrics.span("render_pages"):
+        if _render_workers <= 1 or len(pages) == 1:
+            images = [render_page(page_pdf, dpi) for page_pdf, dpi in zip(page_pdfs, dpis)]
+        else:
+            images = list(_get_executor().map(render_page, page_pdfs, dpis))
+    metrics.add("image_pages", len(images))
+    metrics.add("image_bytes", sum(len(image) for image in images))
+    return images
+
+def plan_images(file_bytes, page_texts=None, use_text_layer=True):
+    # None when every page has a text layer (the text and upload paths handle those); otherwise the
+    # per-page contents: text for pages with a usable text layer, a rendered image for the rest.
+    # With use_text_layer=False the text layer only tells scanned pages apart and is never sent, so a PDF
+    # with any usable text page is uploaded as it is rather than rendered page by page.
+    if page_texts is None:
+        page_texts = read_text_layer(file_bytes)
+    scanned = [i for i, text in enumerate(page_texts) if len("".join(text.split())) < MIN_PAGE_CHARS]
+    if not scanned:
+        return None
+    text_pages = [text for i, text in enumerate(page_texts) if i not in scanned]
+    if text_pages and not has_usable_text_layer(text_pages):
+        # A garbled text layer is no better than none
+        scanned = list(range(len(page_texts)))
+    elif text_pages and not use_text_layer:
+        return None
+
+    images = dict(zip(scanned, render_pages(file_bytes, scanned)))
+    page_parts = []
+    for i, text in enumerate(page_texts):
+        if i in images:
+            page_parts.append([f"--- Page {i + 1} (scanned image) ---", {"mime_type": "image/jpeg", "data": images[i]}])
+        else:
+            page_parts.append([f"--- Page {i + 1} ---\n{text}"])
+    image_bytes = sum(len(image) for image in images.values())
+    text_bytes = sum(len(part[0].encode("utf-8")) for i, part in enumerate(page_parts) if i not in images)
+    return {"page_parts": page_parts, "image_pages": len(images), "image_bytes": image_bytes, "upload_bytes": image_bytes + text_bytes}
+
+def build_image_contents(prompt, page_parts):
+    contents = [
+        f"{prompt}\n\n"
+        "## Document Pages\n"
+        "Pages with a text layer are given as text with their column layout preserved; scanned pages are attached as images.\n"
+    ]
+    for parts in page_parts:
+        contents.extend(parts)
+    return contents
@@ -0,0 +1,106 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pypdf import PdfReader, PdfWriter
+
+import metrics
+
+CHUNK_PAGES = int(os.getenv("CHUNK_PAGES", "4"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "1"))
+CHUNK_MIN_PAGES = int(os.getenv("CHUNK_MIN_PAGES", "6"))
+CHUNK_CONCURRENCY = int(os.getenv("CHUNK_CONCURRENCY", "4"))
+
+HEADER_FIELDS = ("company", "vat", "name", "contact", "priceGuaranteeDay")
+SUMMARY_FIELDS = ("totalPrice", "totalVat", "totalPriceIncludeVat")
+
+def count_pages(file_bytes):
+    return len(PdfReader(io.BytesIO(file_bytes)).pages)
+
+def page_ranges(page_count, pages_per_chunk=CHUNK_PAGES, overlap=CHUNK_OVERLAP):
+    # Overlapping [start, end) ranges so a row split across a page break is complete in at least one chunk
+    if page_count <= pages_per_chunk:
+        return [(0, page_count)]
+    step = max(1, pages_per_chunk - overlap)
+    ranges = []
+    start = 0
+    while True:
+        end = min(start + pages_per_chunk, page_count)
+        ranges.append((start, end))
+        if end == page_count:
+            return ranges
+        start += step
+
+def split_pdf(file_bytes, ranges):
+    reader = PdfReader(io.BytesIO(file_bytes))
+    chunks = []
+    for start, end in ranges:
+        writer = PdfWriter()
+        for page in reader.pages[start:end]:
+            writer.add_page(page)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        chunks.append(buffer.getvalue())
+    return chunks
+
+def chunk_prompt(prompt, start, end, page_count):
+    return (
+        f"{prompt}\n\n"
+        "## Partial Document\n"
+        f"This input contains only pages {start + 1}-{end} of a {page_count}-page quotation. "
+        "Extract every line item on these pages. "
+        "If the company details or the price summary are not on these pages, use null for those fields.\n"
+    )
+
+def _product_key(product):
+    return (
+        " ".join(str(product.get("name", "")).split()),
+        product.get("quantity"),
+        product.get("pricePerUnit"),
+        product.get("totalPrice"),
+    )
+
+def _overlap_length(previous_keys, current_keys):
+    for length in range(min(len(previous_keys), len(current_keys)), 0, -1):
+        if previous_keys[-length:] == current_keys[:length]:
+            return length
+    return 0
+
+def merge_chunk_results(chunk_results):
+    # Header fields come from the first chunk that has them, summary fields from the last one
+    merged = {}
+    for data in chunk_results:
+        for field in HEADER_FIELDS:
+            if merged.get(field) is None and data.get(field) is not None:
+                merged[field] = data[field]
+    for data in reversed(chunk_results):
+        if any(data.get(field) for field in SUMMARY_FIELDS):
+            for field in SUMMARY_FIELDS + ("summaryItems",):
+                if field in data:
+                    merged[field] = data[field]
+            break
+
+    products = []
+    previous_keys = []
+    for data in chunk_results:
+        chunk_products = data.get("products") or []
+        current_keys = [_product_key(product) for product in chunk_products]
+        # Rows on the overlapping page were already taken from the previous chunk: they are the longest run of
+        # this chunk's first rows that repeats the previous chunk's last rows, in order
+        overlap = _overlap_length(previous_keys, current_keys)
+        products.extend(chunk_products[overlap:])
+        previous_keys = current_keys
+
+    merged["products"] = products
+    for field in SUMMARY_FIELDS:
+        merged.setdefault(field, 0)
+    merged.setdefault("company", "")
+    return merged
+
+def extract_chunks(extract_chunk, ranges, max_workers=CHUNK_CONCURRENCY):
+    # extract_chunk(chunk_index, start, end) returns the parsed JSON for that page range or None
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(ranges)))) as executor:
+        results = list(executor.map(metrics.carry(lambda args: extract_chunk(*args)), [(i, start, end) for i, (start, end) in enumerate(ranges)]))
+    if any(result is None for result in results):
+        return None
+    return merge_chunk_results(results)
@@ -0,0 +1,195 @@
+import io
+import logging
+import os
+import re
+
+from pypdf import PdfReader
+
+logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+TEXT_PATH_ENABLED = os.getenv("TEXT_PATH_DISABLED", "").lower() not in ("1", "true", "yes")
+MIN_PAGE_CHARS = 200
+MAX_GARBLED_RATIO = 0.005
+# Gemini bills every PDF page as an image on top of its text layer
+PDF_PAGE_TOKENS = 258
+AMOUNT_TOLERANCE = 1.0
+
+# Glyphs from broken font cmaps (Latin Extended, Cyrillic, private use) show up instead of Thai digits and vowels
+GARBLED_CHARS = re.compile(r'[\u0100-\u024f\u0400-\u04ff\ue000-\uf8ff]')
+# pypdf splits sara am (ำ) into a space plus sara aa (า), and leaves a space before detached vowels
+SPLIT_SARA_AM = re.compile(r'(?<=[\u0e01-\u0e2e]) ([\u0e48-\u0e4b]?)\u0e32')
+DETACHED_SARA_AM = re.compile(r'(?<=[\u0e01-\u0e2e\u0e48-\u0e4b]) \u0e33')
+
+NUMBER = r'-?[\d,]+(?:\.\d+)?'
+AMOUNT = r'-?[\d,]+\.\d{2}'
+PRODUCT_ROW = re.compile(
+    rf'^\s*(?P<name>\S.*?)\s{{2,}}(?P<quantity>{NUMBER})\s+(?P<unit>\S+)\s+(?P<price>{AMOUNT})\s+(?P<total>{AMOUNT})\s*$'
+)
+SUMMARY_ROW = re.compile(rf'^\s*(?P<label>\S.*?)\s{{2,}}(?P<value>{AMOUNT})\s*$')
+ITEM_NUMBER = re.compile(r'^\d+(?:\.\d+)*\s+')
+PHONE = re.compile(r'0\d{1,2}[- ]?\d{3}[- ]?\d{3,4}')
+EMAIL = re.compile(r'[\w.+-]+@[\w-]+\.[\w.]+')
+PRICE_GUARANTEE = re.compile(r'(?:ยืนราคา|ยืนยันราคา)\D{0,20}?(\d+)\s*(?:วัน|Days)', re.IGNORECASE)
+
+VAT_LABELS = ("ภาษีมูลค่าเพิ่ม", "ภาษีมูลค้าเพิ่ม", "vat")
+GRAND_TOTAL_LABELS = ("ยอดรวมทั้งสิ้น", "รวมทั้งสิ้น", "รวมทั้งหมด", "รวมเงินทั้งสิน", "สุทธิ", "including vat", "grand total")
+SUBTOTAL_LABELS = ("รวมเป็นเงิน", "ราคารวม", "รวมราคา", "รวม", "total")
+
+def repair_thai_text(text):
+    text = SPLIT_SARA_AM.sub(lambda m: m.group(1) + "\u0e33", text)
+    return DETACHED_SARA_AM.sub("\u0e33", text)
+
+def read_text_layer(file_bytes):
+    reader = PdfReader(io.BytesIO(file_bytes))
+    pages = []
+    for page in reader.pages:
+        try:
+            text = page.extract_text(extraction_mode="layout") or ""
+        except Exception:
+            text = page.extract_text() or ""
+        pages.append(repair_thai_text(text))
+    return pages
+
+def has_usable_text_layer(pages):
+    if not pages:
+        return False
+    for text in pages:
+        if len("".join(text.split())) < MIN_PAGE_CHARS:
+            return False
+    content = "".join("".join(text.split()) for text in pages)
+    return len(GARBLED_CHARS.findall(content)) / len(content) <= MAX_GARBLED_RATIO
+
+def estimate_tokens(text):
+    # Rough average for mixed Thai/English quotation text
+    return len(text) // 4
+
+def _to_number(value):
+    return float(value.replace(",", ""))
+
+def _classify_summary(label):
+    label = label.lower()
+    if any(key in label for key in VAT_LABELS):
+        return "totalVat"
+    if any(key in label for key in GRAND_TOTAL_LABELS):
+        return "totalPriceIncludeVat"
+    if any(key in label for key in SUBTOTAL_LABELS):
+        return "totalPrice"
+    return None
+
+def parse_quotation_table(pages):
+    # Only returns a result when every row reconciles with the document's own totals;
+    # anything less certain is left to the model
+    lines = [line for text in pages for line in text.splitlines()]
+    products = []
+    summary = {}
+    summary_items = []
+    pending_gap = False
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        row = PRODUCT_ROW.match(line)
+        if row and not summary:
+            quantity = _to_number(row.group("quantity"))
+            price = _to_number(row.group("price"))
+            total = _to_number(row.group("total"))
+            if abs(quantity * price - total) > AMOUNT_TOLERANCE:
+                return None
+            if pending_gap:
+                # Free text between rows is usually a wrapped description we cannot attribute safely
+                return None
+            products.append({
+                "name": " ".join(ITEM_NUMBER.sub("", row.group("name").strip()).split()),
+                "quantity": quantity,
+                "unit": row.group("unit"),
+                "pricePerUnit": price,
+                "totalPrice": total
+            })
+            continue
+
+        summary_row = SUMMARY_ROW.match(line)
+        if summary_row and products:
+            # Keep only the right-most column so amounts written out in words are dropped
+            label = re.split(r'\s{2,}', summary_row.group("label").strip())[-1]
+            field = _classify_summary(label)
+            if field:
+                value = _to_number(summary_row.group("value"))
+                summary_items.append({"label": label, "value": value})
+                summary.setdefault(field, value)
+                continue
+
+        if products and not summary and not ITEM_NUMBER.match(line.strip()):
+            pending_gap = True
+
+    if not products or "totalPrice" not in summary:
+        return None
+    if abs(sum(product["totalPrice"] for product in products) - summary["totalPrice"]) > AMOUNT_TOLERANCE:
+        return None
+    total_vat = summary.get("totalVat", 0)
+    total_include_vat = summary.get("totalPriceIncludeVat", summary["totalPrice"] + total_vat)
+    if abs(summary["totalPrice"] + total_vat - total_include_vat) > AMOUNT_TOLERANCE:
+        return None
+
+    header_text = "\n".join(lines[:40])
+    company = next(line.strip() for line in lines if line.strip())
+    customer = re.search(r'เรียน\s+(.+)', header_text)
+    contact = PHONE.search(header_text) or EMAIL.search(header_text)
+    guarantee = PRICE_GUARANTEE.search("\n".join(lines))
+
+    return {
+        "company": company,
+        "vat": total_vat > 0,
+        "name": customer.group(1).strip() if customer else None,
+        "contact": contact.group(0) if contact else None,
+        "priceGuaranteeDay": int(guarantee.group(1)) if guarantee else 0,
+        "products": products,
+        "summaryItems": summary_items,
+        "totalPrice": summary["totalPrice"],
+        "totalVat": total_vat,
+        "totalPriceIncludeVat": total_include_vat
+    }
+
+def build_text_prompt(prompt, pages, first_page=1):
+    pages_text = "\n\n".join(f"--- Page {i} ---\n{text}" for i, text in enumerate(pages, start=first_page))
+    return (
+        f"{prompt}\n\n"
+        "## Document Text\n"
+        "The quotation below was extracted from the PDF text layer with its column layout preserved.\n\n"
+        f"{pages_text}"
+    )
+
+def plan_extraction(file_bytes, prompt, enabled=TEXT_PATH_ENABLED):
+    # Decides between a fully local parse, a text-only prompt and a binary upload
+    upload_tokens = estimate_tokens(prompt)
+    plan = {"path": "upload", "pages": None, "page_texts": None, "data": None, "text_prompt": None, "input_bytes": len(file_bytes), "saved_bytes": 0, "saved_tokens": 0}
+    if not enabled:
+        return plan
+
+    try:
+        pages = read_text_layer(file_bytes)
+    except Exception:
+        return plan
+
+    plan["pages"] = len(pages)
+    plan["page_texts"] = pages
+    if not has_usable_text_layer(pages):
+        return plan
+
+    text_tokens = sum(estimate_tokens(text) for text in pages)
+    upload_tokens += len(pages) * PDF_PAGE_TOKENS + text_tokens
+
+    data = parse_quotation_table(pages)
+    if data is not None:
+        plan.update(path="local", data=data, saved_bytes=len(file_bytes), saved_tokens=upload_tokens)
+        return plan
+
+    text_prompt = build_text_prompt(prompt, pages)
+    plan.update(
+        path="text",
+        page_texts=pages,
+        text_prompt=text_prompt,
+        saved_bytes=max(0, len(file_bytes) - len(text_prompt.encode("utf-8"))),
+        saved_tokens=max(0, upload_tokens - estimate_tokens(text_prompt))
+    )
+    return plan
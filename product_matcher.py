@@ -0,0 +1,459 @@
+import json
+import re
+import os
+import threading
+import unicodedata
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+import metrics
+from extraction import MODEL_NAME
+from model_sessions import get_session
+from rate_limit import get_limiter
+from structured_output import STRUCTURED_OUTPUT_ENABLED, matching_generation_config
+
+NGRAM_SIZE = 3
+MATCH_THRESHOLD = 0.8
+MATCH_MARGIN = 0.1
+NEW_PRODUCT_THRESHOLD = 0.35
+DIMENSION_TOLERANCE = 0.02
+SHORTLIST_SIZE = int(os.getenv("MATCH_SHORTLIST_SIZE", "8"))
+MATCH_BATCH_SIZE = int(os.getenv("MATCH_BATCH_SIZE", "10"))
+MATCH_CONCURRENCY = int(os.getenv("MATCH_CONCURRENCY", "4"))
+
+matching_prompt = """
+You're a product matching expert for construction materials in Thailand. Analyze products from List B against List A to find matches.
+
+Matching criteria (in order of importance):
+1. Material type (กระจก, อลูมิเนียม, เหล็ก, ไม้, etc.)
+2. Product thickness (e.g., 10 มม., 12 มม.)
+3. Product type/function (บานเลื่อน, บานสวิง, บานพับ, etc.)
+4. Dimensions and measurements 
+5. Location specifications
+
+Consider these important rules:
+- Two products match if they refer to the same physical item despite minor description variations
+- Glass products must match thickness AND type exactly
+- Different dimensions usually indicate different products
+- Different locations (ชั้น 1, ชั้น 2, etc.) indicate different products
+- Similar products with different finishes/colors are NOT matches
+
+Return ONLY a JSON array of integers where each position corresponds to a product in List B:
+- If a match exists in List A, return its index (0-based)
+- If no match exists, return -1
+
+List A:
+{list_a}
+
+List B:
+{list_b}
+"""
+
+# Everything before the two lists is static and is kept on a long-lived model session
+MATCHING_INSTRUCTIONS = matching_prompt[:matching_prompt.index("List A:")]
+
+def match_products_with_gemini(existing_products, new_products, pad=True):
+    with metrics.span("match_products_with_gemini"):
+        return _match_products_with_gemini(existing_products, new_products, pad)
+
+def _match_products_with_gemini(existing_products, new_products, pad):
+    formatted_prompt = matching_prompt.format(
+        list_a=json.dumps(existing_products, ensure_ascii=False),
+        list_b=json.dumps(new_products, ensure_ascii=False)
+    )
+    
+    session = get_session(MATCHING_INSTRUCTIONS, MODEL_NAME, matching_generation_config() if STRUCTURED_OUTPUT_ENABLED else None)
+    response = get_limiter("gemini").call(session.generate_content, formatted_prompt)
+    metrics.record_usage("matching", response)
+    
+    matches_text = response.text.strip()
+    
+    # With a response_schema the reply is already a bare JSON array; free-form replies need cleaning up first
+    if not STRUCTURED_OUTPUT_ENABLED:
+        if '```' in matches_text:
+            code_block_pattern = r'```(?:json)?(.*?)```'
+            matches = re.findall(code_block_pattern, matches_text, re.DOTALL)
+            if matches:
+                matches_text = matches[0].strip()
+        
+        if matches_text.lower().startswith('json'):
+            matches_text = matches_text[4:].strip()
+        
+        array_pattern = r'\[(.*?)\]'
+        array_matches = re.search(array_pattern, matches_text, re.DOTALL)
+        if array_matches:
+            matches_text = f"[{array_matches.group(1)}]"
+    
+    if not matches_text:
+        return [-1] * len(new_products) if pad else []
+    
+    try:
+        matches = json.loads(matches_text)
+        if not isinstance(matches, list):
+            matches = [-1] * len(new_products) if pad else []
+    except json.JSONDecodeError:
+        matches = [-1] * len(new_products) if pad else []
+    
+    if pad and len(matches) < len(new_products):
+        matches.extend([-1] * (len(new_products) - len(matches)))
+    
+    return matches
+
+THAI_DIGITS = str.maketrans("๐๑๒๓๔๕๖๗๘๙", "0123456789")
+UNIT_PATTERNS = [
+    (re.compile(r'(\d)\s*(?:มม\.?|มิลลิเมตร|mm\.?)', re.IGNORECASE), r'\1 มม '),
+    (re.compile(r'(\d)\s*(?:ซม\.?|เซนติเมตร|cm\.?)', re.IGNORECASE), r'\1 ซม '),
+    (re.compile(r'(\d)\s*(?:ม\.|เมตร|ม(?![\u0e01-\u0e4e])|m\b)', re.IGNORECASE), r'\1 ม '),
+]
+DIMENSION_SEPARATOR = re.compile(r'(\d)\s*[x×*]\s*(?=\d)', re.IGNORECASE)
+DIMENSION = re.compile(r'(\d+(?:\.\d+)?)x(\d+(?:\.\d+)?)(?:x(\d+(?:\.\d+)?))?')
+THICKNESS = re.compile(r'(\d+(?:\.\d+)?) มม')
+FLOOR = re.compile(r'ชั้น\s*(\d+(?:\s*[-,]\s*\d+)*)')
+UNIT_NUMBER = re.compile(r'unit\s*(\d+)', re.IGNORECASE)
+
+# Keyword groups from the matching rules: a product cannot match one whose value in the same group differs
+KEYWORD_GROUPS = {
+    "material": ("กระจก", "อลูมิเนียม", "สแตนเลส", "เหล็ก", "ไม้", "ยิปซั่ม", "ปูน", "พีวีซี", "upvc"),
+    "glass_process": ("เทมเปอร์", "ลามิเนต", "ฮีทสเตรงเทน", "ฮีทสตรีงเทน", "ธรรมดา"),
+    "glass_color": ("ยูโรเกรย์", "เกรย์", "ใส", "เขียว", "ชาดำ", "บรอนซ์", "ฝ้า", "สะท้อนแสง", "low-e"),
+    "finish": ("สีดำ", "สีขาว", "สีเทา", "สีเงิน", "สีชา", "สีทอง", "อบสี", "ขัดเงา", "ขัดด้าน", "hairline", "อโนไดซ์"),
+    "function": ("บานเลื่อน", "บานสวิง", "บานพับ", "บานเฟี้ยม", "บานกระทุ้ง", "บานฟิกซ์", "ราวบันได", "ราวกันตก", "ฉากกั้นอาบน้ำ"),
+}
+
+@lru_cache(maxsize=65536)
+def normalize_product_name(name):
+    text = unicodedata.normalize("NFC", str(name)).translate(THAI_DIGITS).lower()
+    text = DIMENSION_SEPARATOR.sub(r'\1x', text)
+    for pattern, replacement in UNIT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return " ".join(text.split())
+
+def _find_keywords(text, keywords):
+    found = set()
+    for keyword in sorted(keywords, key=len, reverse=True):
+        if keyword in text:
+            found.add(keyword)
+            text = text.replace(keyword, " ")
+    return frozenset(found)
+
+@lru_cache(maxsize=65536)
+def parse_product_keys(name):
+    text = normalize_product_name(name)
+    dimensions = set()
+    for match in DIMENSION.finditer(text):
+        dimensions.add(tuple(sorted(float(value) for value in match.groups() if value)))
+    without_dimensions = DIMENSION.sub(" ", text)
+
+    locations = set()
+    for match in FLOOR.finditer(text):
+        locations.add("ชั้น " + re.sub(r'\s+', '', match.group(1)))
+    if "ลอย" in text:
+        locations.add("ลอย")
+    for match in UNIT_NUMBER.finditer(text):
+        locations.add("unit " + match.group(1))
+
+    keys = {
+        "thickness": frozenset(float(value) for value in THICKNESS.findall(without_dimensions)),
+        "dimensions": frozenset(dimensions),
+        "location": frozenset(locations),
+    }
+    for group, keywords in KEYWORD_GROUPS.items():
+        keys[group] = _find_keywords(text, keywords)
+    return keys
+
+def _dimensions_overlap(a, b):
+    for dims_a in a:
+        for dims_b in b:
+            if len(dims_a) == len(dims_b) and all(
+                abs(x - y) <= DIMENSION_TOLERANCE * max(x, y, 1e-9) for x, y in zip(dims_a, dims_b)
+            ):
+                return True
+    return False
+
+def keys_compatible(a, b):
+    if a["location"] and b["location"] and a["location"] != b["location"]:
+        return False
+    if a["thickness"] and b["thickness"] and not a["thickness"] & b["thickness"]:
+        return False
+    for group in KEYWORD_GROUPS:
+        if a[group] and b[group] and not a[group] & b[group]:
+            return False
+    # Dimensions last: the tolerance comparison is the most expensive check
+    if a["dimensions"] and b["dimensions"] and not _dimensions_overlap(a["dimensions"], b["dimensions"]):
+        return False
+    return True
+
+def _ngrams(text):
+    text = text.replace(" ", "")
+    if len(text) <= NGRAM_SIZE:
+        return {text} if text else set()
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+class ProductMatcher:
+    def __init__(self, existing_products=()):
+        self.names = []
+        self.normalized = {}
+        self.keys = []
+        self.gram_counts = []
+        self.index = defaultdict(list)
+        # numpy copies of the posting lists and n-gram counts, rebuilt lazily after add()
+        self._posting_arrays = {}
+        self._gram_count_array = None
+        for name in existing_products:
+            self.add(name)
+
+    def add(self, name):
+        idx = len(self.names)
+        normalized = normalize_product_name(name)
+        grams = _ngrams(normalized)
+        self.names.append(name)
+        self.normalized.setdefault(normalized, idx)
+        self.keys.append(parse_product_keys(name))
+        self.gram_counts.append(len(grams))
+        for gram in grams:
+            self.index[gram].append(idx)
+            self._posting_arrays.pop(gram, None)
+        self._gram_count_array = None
+        return idx
+
+    def _postings(self, gram):
+        postings = self._posting_arrays.get(gram)
+        if postings is None:
+            postings = np.array(self.index[gram], dtype=np.int32)
+            self._posting_arrays[gram] = postings
+        return postings
+
+    def _ranked(self, name, min_score):
+        # Jaccard similarity over character n-grams, computed only for products sharing at least one n-gram
+        grams = _ngrams(normalize_product_name(name))
+        postings = [self._postings(gram) for gram in grams if gram in self.index]
+        if not postings:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        if self._gram_count_array is None:
+            self._gram_count_array = np.array(self.gram_counts, dtype=np.int32)
+
+        overlaps = np.bincount(np.concatenate(postings), minlength=len(self.names))
+        ids = np.nonzero(overlaps)[0]
+        shared = overlaps[ids]
+        scores = shared / (len(grams) + self._gram_count_array[ids] - shared)
+        keep = scores >= min_score
+        ids, scores = ids[keep], scores[keep]
+        order = np.argsort(-scores, kind="stable")
+        return ids[order], scores[order]
+
+    def candidates(self, name, limit=5, min_score=0.0):
+        ids, scores = self._ranked(name, min_score)
+        if limit:
+            ids, scores = ids[:limit], scores[:limit]
+        return list(zip(ids.tolist(), scores.tolist()))
+
+    def compatible_candidates(self, name, limit, min_score=NEW_PRODUCT_THRESHOLD):
+        # Best-scoring candidates whose structured keys do not conflict, stopping once limit are found
+        keys = parse_product_keys(name)
+        ids, scores = self._ranked(name, min_score)
+        found = []
+        for idx, score in zip(ids.tolist(), scores.tolist()):
+            if keys_compatible(keys, self.keys[idx]):
+                found.append((idx, score))
+                if len(found) >= limit:
+                    break
+        return found
+
+    def shortlist(self, name, limit=SHORTLIST_SIZE):
+        return [idx for idx, _ in self.compatible_candidates(name, limit)]
+
+    def match_one(self, name):
+        # Returns (index, confident); index is -1 for a new product
+        normalized = normalize_product_name(name)
+        if normalized in self.normalized:
+            return self.normalized[normalized], True
+
+        compatible = self.compatible_candidates(name, limit=2)
+        if not compatible:
+            return -1, True
+
+        best_idx, best_score = compatible[0]
+        runner_up = compatible[1][1] if len(compatible) > 1 else 0.0
+        if best_score >= MATCH_THRESHOLD and best_score - runner_up >= MATCH_MARGIN:
+            return best_idx, True
+        return -1, False
+
+def request_llm_matches(list_a, list_b):
+    return match_products_with_gemini(list_a, list_b, pad=False)
+
+def _match_batch(matcher, batch, llm_match):
+    # batch is a list of (name, shortlist); List A holds only the union of the batch's shortlists
+    candidate_ids = sorted({idx for _, shortlist in batch for idx in shortlist})
+    if not candidate_ids:
+        return [-1] * len(batch)
+
+    indices = llm_match([matcher.names[idx] for idx in candidate_ids], [name for name, _ in batch])
+    if not isinstance(indices, list) or len(indices) != len(batch):
+        # A short or malformed array usually means the response was truncated; retry smaller halves
+        if len(batch) == 1:
+            return [-1]
+        middle = len(batch) // 2
+        return _match_batch(matcher, batch[:middle], llm_match) + _match_batch(matcher, batch[middle:], llm_match)
+
+    results = []
+    for local_idx in indices:
+        if isinstance(local_idx, int) and 0 <= local_idx < len(candidate_ids):
+            results.append(candidate_ids[local_idx])
+        else:
+            results.append(-1)
+    return results
+
+def match_products(matcher, new_products, llm_match=request_llm_matches, batch_size=MATCH_BATCH_SIZE, max_workers=MATCH_CONCURRENCY):
+    # Resolves confident matches locally and sends only the ambiguous names to the LLM,
+    # in fixed-size batches that carry just each item's shortlisted candidates
+    match_indices = []
+    ambiguous = []
+    for i, name in enumerate(new_products):
+        match_idx, confident = matcher.match_one(name)
+        match_indices.append(match_idx)
+        if not confident:
+            ambiguous.append(i)
+
+    if ambiguous and llm_match is not None:
+        items = [(new_products[i], matcher.shortlist(new_products[i])) for i in ambiguous]
+        batches = [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as executor:
+            batch_results = list(executor.map(metrics.carry(lambda batch: _match_batch(matcher, batch, llm_match)), batches))
+        llm_indices = [idx for result in batch_results for idx in result]
+        for i, match_idx in zip(ambiguous, llm_indices):
+            if match_idx >= 0:
+                match_indices[i] = match_idx
+
+    stats = {"local": len(new_products) - len(ambiguous), "llm": len(ambiguous) if llm_match is not None else 0}
+    return match_indices, stats
+
+class BatchMatcher:
+    # Matches every supplier of a run in one pass instead of one supplier after another. Each quotation's
+    # names are resolved against the master list as soon as it is added (ambiguous names from all suppliers
+    # share full LLM batches that start in the background, so this overlaps with extracting later files);
+    # finish() then clusters the products that are new to the master list into canonical items across suppliers.
+    def __init__(self, existing_products, llm_match=request_llm_matches, batch_size=MATCH_BATCH_SIZE, max_workers=MATCH_CONCURRENCY):
+        self.existing_products = list(existing_products)
+        self.matcher = ProductMatcher(self.existing_products)
+        self.llm_match = llm_match
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.names = {}
+        self._resolved = {}
+        self._llm_names = set()
+        self._ambiguous = []
+        self._batches = []
+        self._classified = []
+        self._executor = None
+        self._classifier = None
+        self._lock = threading.Lock()
+
+    def add(self, key, names):
+        # key identifies the supplier (update_google_sheet_with_multiple_files uses the tuple of product names).
+        # Returns at once: the names are matched on a background thread, in the order they were added.
+        with self._lock:
+            if key in self.names:
+                return
+            self.names[key] = list(names)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+                self._classifier = ThreadPoolExecutor(max_workers=1)
+            self._classified.append(self._classifier.submit(metrics.carry(self._classify), self.names[key]))
+
+    def _classify(self, names):
+        for name in names:
+            normalized = normalize_product_name(name)
+            if normalized in self._resolved or normalized in self._llm_names:
+                continue
+            match_idx, confident = self.matcher.match_one(name)
+            if confident or self.llm_match is None:
+                self._resolved[normalized] = match_idx
+            else:
+                self._llm_names.add(normalized)
+                self._ambiguous.append((name, self.matcher.shortlist(name)))
+        # Full batches start right away; the remainder waits for finish()
+        while len(self._ambiguous) >= self.batch_size:
+            self._submit(self._ambiguous[:self.batch_size])
+            self._ambiguous = self._ambiguous[self.batch_size:]
+
+    def _submit(self, batch):
+        self._batches.append((batch, self._executor.submit(metrics.carry(_match_batch), self.matcher, batch, self.llm_match)))
+
+    def finish(self, keys=None):
+        # keys are the suppliers to cluster, in the upload order (add() sees files in the order they finish);
+        # by default every supplier added. Returns {"targets": {key: [target per name]}, "stats": {key: {"local", "llm"}}}; a target is
+        # ("existing", master list index) or ("new", cluster index)
+        with self._lock:
+            try:
+                for future in self._classified:
+                    future.result()
+                if self._ambiguous:
+                    self._submit(self._ambiguous)
+                    self._ambiguous = []
+                for batch, future in self._batches:
+                    for (name, _), match_idx in zip(batch, future.result()):
+                        self._resolved[normalize_product_name(name)] = match_idx
+            finally:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._classifier.shutdown(wait=False)
+                    self._executor = None
+                    self._classifier = None
+                self._classified = []
+                self._batches = []
+
+            # Products new to the master list are clustered supplier by supplier, as the serial path added them:
+            # a line can join an item of an earlier supplier but never another line of its own quotation. Lines
+            # that are ambiguous start their own cluster and go to one shared LLM pass that may merge them.
+            clusters = ProductMatcher()
+            line_clusters = {}
+            pending = []
+            pending_count = defaultdict(int)
+            order = list(self.names) if keys is None else list(dict.fromkeys(keys))
+            for key in order:
+                names = self.names[key]
+                line_clusters[key] = [None] * len(names)
+                added = []
+                for pos, name in enumerate(names):
+                    if self._resolved[normalize_product_name(name)] >= 0:
+                        continue
+                    cluster_idx, confident = clusters.match_one(name)
+                    if cluster_idx >= 0:
+                        line_clusters[key][pos] = cluster_idx
+                    else:
+                        shortlist = [] if confident or self.llm_match is None else clusters.shortlist(name)
+                        added.append((pos, name, shortlist))
+                for pos, name, shortlist in added:
+                    cluster_idx = clusters.add(name)
+                    line_clusters[key][pos] = cluster_idx
+                    if shortlist:
+                        pending.append((cluster_idx, (name, shortlist)))
+                        pending_count[key] += 1
+
+            merged = list(range(len(clusters.names)))
+            if pending:
+                batches = [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+                with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(batches)))) as executor:
+                    results = list(executor.map(metrics.carry(lambda batch: _match_batch(clusters, [item for _, item in batch], self.llm_match)), batches))
+                match_indices = [idx for result in results for idx in result]
+                # Candidates always come from earlier suppliers, so following merged[] in order resolves chains
+                for (cluster_idx, _), match_idx in zip(pending, match_indices):
+                    if match_idx >= 0:
+                        merged[cluster_idx] = merged[match_idx]
+
+            targets = {}
+            stats = {}
+            for key in order:
+                names = self.names[key]
+                targets[key] = []
+                for name, cluster_idx in zip(names, line_clusters[key]):
+                    if cluster_idx is None:
+                        targets[key].append(("existing", self._resolved[normalize_product_name(name)]))
+                    else:
+                        targets[key].append(("new", merged[cluster_idx]))
+                llm = sum(normalize_product_name(name) in self._llm_names for name in names) + pending_count[key]
+                stats[key] = {"local": len(names) - llm, "llm": llm}
+            return {"targets": targets, "stats": stats}
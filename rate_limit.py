@@ -0,0 +1,220 @@
+import os
+import random
+import re
+import threading
+import time
+
+import metrics
+
+# Shared rate limiting for the Gemini and Google Sheets APIs: a token bucket caps the request rate,
+# AIMD adjusts how many calls run at once, and throttled calls are retried with jittered exponential backoff
+
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "300"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+SHEETS_REQUESTS_PER_MINUTE = float(os.getenv("SHEETS_REQUESTS_PER_MINUTE", "60"))
+SHEETS_MAX_CONCURRENCY = int(os.getenv("SHEETS_MAX_CONCURRENCY", "2"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "6"))
+RATE_LIMIT_BASE_DELAY = float(os.getenv("RATE_LIMIT_BASE_DELAY", "1.0"))
+RATE_LIMIT_MAX_DELAY = float(os.getenv("RATE_LIMIT_MAX_DELAY", "60.0"))
+
+THROTTLE_STATUS = {429, 503}
+RETRYABLE_STATUS = THROTTLE_STATUS | {500, 502, 504}
+THROTTLE_MESSAGES = ("quota exceeded", "rate limit", "resource exhausted", "resource has been exhausted", "too many requests", "overloaded")
+RETRY_AFTER = re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE)
+
+def status_code(exc):
+    # google.api_core errors and gspread's APIError both carry an int code; gspread falls back to -1
+    # when the error body is not JSON, so the HTTP response status is checked as well
+    code = getattr(exc, "code", None)
+    if isinstance(code, int) and code > 0:
+        return int(code)
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return status
+    return None
+
+def is_throttled(exc):
+    code = status_code(exc)
+    if code is not None:
+        return code in THROTTLE_STATUS
+    message = str(exc).lower()
+    return any(text in message for text in THROTTLE_MESSAGES)
+
+def is_retryable(exc):
+    code = status_code(exc)
+    if code is not None:
+        return code in RETRYABLE_STATUS
+    return is_throttled(exc)
+
+class TokenBucket:
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        # rate is tokens per second; a rate of 0 disables the bucket
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+            waited += wait
+
+class AdaptiveConcurrency:
+    # Additive increase (+1 slot per window of successful calls), multiplicative decrease on throttling
+    def __init__(self, maximum, minimum=1, initial=None, decrease=0.5, cooldown=1.0, clock=time.monotonic):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(initial if initial is not None else self.maximum)
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.clock = clock
+        self.in_flight = 0
+        self._last_decrease = None
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, outcome):
+        # outcome is "success", "throttled" or None for errors that say nothing about the quota
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "success":
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif outcome == "throttled":
+                now = self.clock()
+                # Calls already in flight when the quota ran out fail together; count them as one signal
+                if self._last_decrease is None or now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            self._condition.notify_all()
+
+class RateLimiter:
+    def __init__(
+        self, name, requests_per_minute, max_concurrency, burst=None, max_retries=RATE_LIMIT_MAX_RETRIES,
+        base_delay=RATE_LIMIT_BASE_DELAY, max_delay=RATE_LIMIT_MAX_DELAY, clock=time.monotonic, sleep=time.sleep, rng=None
+    ):
+        rate = requests_per_minute / 60.0
+        self.name = name
+        self.bucket = TokenBucket(rate, burst if burst is not None else max(1.0, rate), clock=clock, sleep=sleep)
+        self.concurrency = AdaptiveConcurrency(max_concurrency, cooldown=base_delay, clock=clock)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.rng = rng or random.Random()
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "failed": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def backoff(self, attempt, exc=None):
+        # Full jitter: a random delay up to the exponential cap, but never shorter than a server-provided retry hint
+        delay = self.rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = RETRY_AFTER.search(str(exc)) if exc is not None else None
+        if hint:
+            delay = max(delay, min(self.max_delay, float(hint.group(1))))
+        return delay
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.concurrency.acquire()
+            self.bucket.acquire()
+            self._count("calls")
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttled(e)
+                self.concurrency.release("throttled" if throttled else None)
+                if throttled:
+                    self._count("throttled")
+                    metrics.add(f"{self.name}_throttled")
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    self._count("failed")
+                    raise
+                self._count("retries")
+                metrics.add(f"{self.name}_retries")
+                self.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            self.concurrency.release("success")
+            return result
+
+class RateLimitedClient:
+    # Wraps an extraction client (GeminiExtractionClient or a stub) so every model call goes through a limiter
+    def __init__(self, client, limiter=None):
+        self.client = client
+        self.limiter = limiter or get_limiter("gemini")
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def extract(self, file_name, file_bytes, prompt=None):
+        return self.limiter.call(self.client.extract, file_name, file_bytes, prompt=prompt)
+
+    def extract_text(self, file_name, text_prompt):
+        return self.limiter.call(self.client.extract_text, file_name, text_prompt)
+
+    def _stream(self, method, *args, **kwargs):
+        # Throttling surfaces when the request is made, i.e. before the first chunk, so only that part is retried
+        def start():
+            chunks = iter(method(*args, **kwargs))
+            return next(chunks, None), chunks
+
+        first, chunks = self.limiter.call(start)
+        if first is not None:
+            yield first
+        for chunk in chunks:
+            yield chunk
+
+    def extract_stream(self, file_name, file_bytes, prompt=None):
+        return self._stream(self.client.extract_stream, file_name, file_bytes, prompt=prompt)
+
+    def extract_text_stream(self, file_name, text_prompt):
+        return self._stream(self.client.extract_text_stream, file_name, text_prompt)
+
+    def extract_images(self, file_name, page_parts, prompt=None):
+        return self.limiter.call(self.client.extract_images, file_name, page_parts, prompt=prompt)
+
+    def extract_images_stream(self, file_name, page_parts, prompt=None):
+        return self._stream(self.client.extract_images_stream, file_name, page_parts, prompt=prompt)
+
+LIMITER_DEFAULTS = {
+    "gemini": {"requests_per_minute": GEMINI_REQUESTS_PER_MINUTE, "max_concurrency": GEMINI_MAX_CONCURRENCY},
+    "sheets": {"requests_per_minute": SHEETS_REQUESTS_PER_MINUTE, "max_concurrency": SHEETS_MAX_CONCURRENCY},
+}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(name):
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name, **LIMITER_DEFAULTS[name])
+        return _limiters[name]
+
+def configure_limiter(name, **kwargs):
+    # Replaces the shared limiter, e.g. to split the quota between worker processes or to speed up tests
+    options = dict(LIMITER_DEFAULTS.get(name, {}), **kwargs)
+    with _limiters_lock:
+        _limiters[name] = RateLimiter(name, **options)
+        return _limiters[name]
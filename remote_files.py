@@ -0,0 +1,140 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+import metrics
+
+# Registry of files already uploaded to the Gemini Files API, keyed by content hash, so the same PDF (or page
+# range) is referenced by URI instead of uploaded again. Uploads stream from memory; nothing touches the disk.
+
+REMOTE_FILES_PATH = os.getenv("REMOTE_FILES_PATH", ".remote_files.json")
+# The Files API deletes uploads after 48 hours, so local entries must lapse before the server copy does
+REMOTE_FILE_MAX_TTL_SECONDS = 47 * 3600
+REMOTE_FILE_TTL_SECONDS = min(int(os.getenv("REMOTE_FILE_TTL_SECONDS", str(24 * 3600))), REMOTE_FILE_MAX_TTL_SECONDS)
+REMOTE_FILES_DISABLED = os.getenv("REMOTE_FILES_DISABLED", "").lower() in ("1", "true", "yes")
+
+class RemoteFileRegistry:
+    def __init__(self, path=REMOTE_FILES_PATH, ttl_seconds=REMOTE_FILE_TTL_SECONDS, enabled=not REMOTE_FILES_DISABLED, genai_module=None, clock=time.time):
+        self.path = path
+        self.ttl_seconds = min(ttl_seconds, REMOTE_FILE_MAX_TTL_SECONDS)
+        self.enabled = enabled
+        self.genai = genai_module
+        self.clock = clock
+        self.stats = {"uploads": 0, "reused": 0, "bytes_uploaded": 0, "bytes_reused": 0, "deleted": 0}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _genai(self):
+        if self.genai is None:
+            import google.generativeai as genai
+            self.genai = genai
+        return self.genai
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self, entries):
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def _count(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self.stats[key] += value
+
+    def _key_lock(self, key):
+        # Two workers sending the same bytes wait for one upload instead of both uploading
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def upload(self, file_name, file_bytes, mime_type="application/pdf"):
+        with metrics.span("upload_file"):
+            remote = self._genai().upload_file(
+                path=io.BytesIO(file_bytes), mime_type=mime_type, display_name=f"PDF for Extraction: {file_name}"
+            )
+        metrics.add("uploads")
+        metrics.add("upload_bytes", len(file_bytes))
+        self._count(uploads=1, bytes_uploaded=len(file_bytes))
+        return remote
+
+    def get_or_upload(self, file_name, file_bytes, mime_type="application/pdf"):
+        # Returns something generate_content accepts: the uploaded File, or a file_data part for a known upload
+        if not self.enabled:
+            return self.upload(file_name, file_bytes, mime_type)
+
+        key = hashlib.sha256(file_bytes).hexdigest()
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._load().get(key)
+            if entry and entry["expires_at"] > self.clock():
+                metrics.add("upload_reused")
+                metrics.add("upload_bytes_saved", len(file_bytes))
+                self._count(reused=1, bytes_reused=len(file_bytes))
+                return {"file_data": {"mime_type": entry["mime_type"], "file_uri": entry["uri"]}}
+
+            remote = self.upload(file_name, file_bytes, mime_type)
+            now = self.clock()
+            with self._lock:
+                entries = self._load()
+                entries[key] = {
+                    "name": remote.name,
+                    "uri": remote.uri,
+                    "mime_type": mime_type,
+                    "size": len(file_bytes),
+                    "uploaded_at": now,
+                    "expires_at": now + self.ttl_seconds,
+                }
+                self._save(entries)
+            return remote
+
+    def forget(self, uri):
+        # The server no longer has the upload behind uri (deleted by hand, or purged by another process), so the
+        # next get_or_upload sends the bytes again
+        with self._lock:
+            entries = self._load()
+            stale = [key for key, entry in entries.items() if entry["uri"] == uri]
+            for key in stale:
+                del entries[key]
+            if stale:
+                self._save(entries)
+        return len(stale)
+
+    def purge_expired(self):
+        # Deletes expired uploads from the Files API instead of leaving them to count against storage until 48h
+        if not self.enabled:
+            return 0
+        now = self.clock()
+        with self._lock:
+            entries = self._load()
+            expired = {key: entry for key, entry in entries.items() if entry["expires_at"] <= now}
+            for key in expired:
+                del entries[key]
+            if expired:
+                self._save(entries)
+        for entry in expired.values():
+            try:
+                self._genai().delete_file(entry["name"])
+            except Exception:
+                # Already gone on the server side
+                pass
+        self._count(deleted=len(expired))
+        return len(expired)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = RemoteFileRegistry()
+        return _registry
@@ -0,0 +1,480 @@
+import os
+import re
+import unicodedata
+
+import metrics
+from product_matcher import SHORTLIST_SIZE, BatchMatcher, ProductMatcher, match_products, normalize_product_name, request_llm_matches
+from rate_limit import get_limiter
+
+COMPANY_NAME_ROW = 1
+CONTACT_INFO_ROW = 2
+HEADER_ROW = 3
+ITEM_MASTER_LIST_COL = 2
+COLUMNS_PER_SUPPLIER = 4
+SUPPLIER_HEADER = ["ปริมาณ", "หน่วย", "ราคาต่อหน่วย", "รวมเป็นเงิน"]
+SUMMARY_LABELS = ("รวมเป็นเงิน", "ภาษีมูลค่าเพิ่ม 7%", "ยอดรวมทั้งสิ้น")
+# Share of a quotation's products that must already be in a same-company block for it to count as a revision
+REVISION_MIN_OVERLAP = float(os.getenv("REVISION_MIN_OVERLAP", "0.5"))
+# Legal-form words and punctuation that differ between revisions of the same supplier's letterhead
+COMPANY_NOISE = re.compile(r"บริษัท|บจก\.?|ห้างหุ้นส่วนจำกัด|หจก\.?|จำกัด|\(มหาชน\)|co\.|company|ltd\.?|limited|inc\.?|[\s.,()&-]")
+
+def column_letter(col):
+    # 1 -> "A", 26 -> "Z", 27 -> "AA"
+    letters = ""
+    while col > 0:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+def _same_value(old, new):
+    new_text = "" if new is None else str(new)
+    if old == new_text:
+        return True
+    # The sheet returns formatted numbers ("1,234.50"), so compare numerically when both sides are numbers
+    try:
+        return float(str(old).replace(",", "")) == float(new_text.replace(",", ""))
+    except ValueError:
+        return False
+
+def _call(worksheet, fn, *args, **kwargs):
+    # Local backends (xlsx_output.LocalWorksheet) do not count against the Sheets API quota
+    if getattr(worksheet, "local", False):
+        return fn(*args, **kwargs)
+    return get_limiter("sheets").call(fn, *args, **kwargs)
+
+class SheetModel:
+    # Local copy of a worksheet: one get_all_values on load, one batch_update of changed cells on flush.
+    # The worksheet is the output backend: a gspread Worksheet, or anything else with the same two calls.
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        with metrics.span("get_all_values"):
+            self.grid = _call(worksheet, worksheet.get_all_values)
+        metrics.add("sheets_reads")
+        if metrics.enabled():
+            metrics.add("sheets_read_bytes", metrics.payload_bytes(self.grid))
+        self.changes = {}
+
+    def get(self, row, col):
+        if (row, col) in self.changes:
+            return "" if self.changes[(row, col)] is None else str(self.changes[(row, col)])
+        if row <= len(self.grid) and col <= len(self.grid[row - 1]):
+            return self.grid[row - 1][col - 1]
+        return ""
+
+    def set(self, row, col, value):
+        original = self.grid[row - 1][col - 1] if row <= len(self.grid) and col <= len(self.grid[row - 1]) else ""
+        if _same_value(original, value):
+            self.changes.pop((row, col), None)
+        else:
+            self.changes[(row, col)] = value
+
+    def set_row(self, row, col, values):
+        for offset, value in enumerate(values):
+            self.set(row, col + offset, value)
+
+    def row_count(self):
+        last_changed = max((row for row, _ in self.changes), default=0)
+        return max(len(self.grid), last_changed)
+
+    def row_values(self, row):
+        width = max([len(self.grid[row - 1]) if row <= len(self.grid) else 0] + [col for r, col in self.changes if r == row])
+        values = [self.get(row, col) for col in range(1, width + 1)]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def col_values(self, col):
+        values = [self.get(row, col) for row in range(1, self.row_count() + 1)]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def pending_payloads(self):
+        # Contiguous changed cells in a row are written as a single range
+        payloads = []
+        changed_cols = {}
+        for row, col in self.changes:
+            changed_cols.setdefault(row, []).append(col)
+        for row in sorted(changed_cols):
+            cols = sorted(changed_cols[row])
+            run = [cols[0]]
+            for col in cols[1:] + [None]:
+                if col is not None and col == run[-1] + 1:
+                    run.append(col)
+                    continue
+                cell_range = f"{column_letter(run[0])}{row}"
+                if len(run) > 1:
+                    cell_range += f":{column_letter(run[-1])}{row}"
+                payloads.append({
+                    'range': cell_range,
+                    'values': [["" if self.changes[(row, c)] is None else self.changes[(row, c)] for c in run]]
+                })
+                if col is not None:
+                    run = [col]
+        return payloads
+
+    def flush(self):
+        payloads = self.pending_payloads()
+        if payloads:
+            with metrics.span("batch_update"):
+                _call(self.worksheet, self.worksheet.batch_update, payloads, value_input_option='USER_ENTERED')
+            metrics.add("sheets_writes")
+            if metrics.enabled():
+                metrics.add("sheets_write_bytes", metrics.payload_bytes(payloads))
+        for (row, col), value in self.changes.items():
+            if len(self.grid) < row:
+                self.grid.extend([] for _ in range(row - len(self.grid)))
+            if len(self.grid[row - 1]) < col:
+                self.grid[row - 1].extend([""] * (col - len(self.grid[row - 1])))
+            self.grid[row - 1][col - 1] = "" if value is None else str(value)
+        written = len(self.changes)
+        self.changes = {}
+        return written
+
+def ensure_first_three_rows_exist(sheet):
+    for i in range(1, 4):
+        sheet.set_row(i, 1, ["", ""])
+
+def find_next_available_column(sheet):
+    max_col = ITEM_MASTER_LIST_COL  # Start with the item master list column
+
+    for row in range(1, HEADER_ROW + 1):  # Check header rows only
+        for i, cell in enumerate(sheet.row_values(row)):
+            if cell.strip():  # If cell has content
+                max_col = max(max_col, i + 1)  # +1 because sheets are 0-indexed but columns start at 1
+
+    return max_col + 1  # Next available column
+
+def check_sheet_template(sheet):
+    header_row = sheet.row_values(HEADER_ROW)
+    if header_row and len(header_row) >= 3 and "ปริมาณ" in header_row and "หน่วย" in header_row and "ราคาต่อหน่วย" in header_row:
+        return True
+    return False
+
+def _company_key(name):
+    text = unicodedata.normalize("NFC", str(name or "")).lower()
+    return COMPANY_NOISE.sub("", text)
+
+def _block_columns(sheet):
+    # Columns where an earlier run started a supplier block: company name above a "ปริมาณ" header
+    columns = []
+    for i, cell in enumerate(sheet.row_values(HEADER_ROW)):
+        col = i + 1
+        if col > ITEM_MASTER_LIST_COL and cell == SUPPLIER_HEADER[0] and sheet.get(COMPANY_NAME_ROW, col).strip():
+            columns.append(col)
+    return columns
+
+def _block_rows(sheet, col):
+    # Item rows the supplier block has values in, keyed by row, with the master-list name of each; summary
+    # rows only fill the last column
+    rows = {}
+    for row in range(HEADER_ROW + 1, sheet.row_count() + 1):
+        name = sheet.get(row, ITEM_MASTER_LIST_COL)
+        if name.strip() and any(sheet.get(row, col + offset) != "" for offset in range(COLUMNS_PER_SUPPLIER - 1)):
+            rows[row] = name
+    return rows
+
+def _block_summary_rows(sheet, col):
+    return [
+        row for row in range(HEADER_ROW + 1, sheet.row_count() + 1)
+        if sheet.get(row, col + 3) != "" and all(sheet.get(row, col + offset) == "" for offset in range(COLUMNS_PER_SUPPLIER - 1))
+    ]
+
+def _pair_names(old_names, new_names):
+    # Pairs each new line with at most one old line, and each old line with at most one new line: equal
+    # normalised names first, then the best-scoring key-compatible candidates, since revisions often reword every
+    # line. Returns {new index: old index}. Revision detection and the revision update both use this pairing.
+    pairs = {}
+    used = set()
+    old_by_name = {}
+    for idx, name in enumerate(old_names):
+        old_by_name.setdefault(normalize_product_name(name), []).append(idx)
+    for pos, name in enumerate(new_names):
+        for idx in old_by_name.get(normalize_product_name(name), []):
+            if idx not in used:
+                pairs[pos] = idx
+                used.add(idx)
+                break
+    matcher = ProductMatcher(old_names)
+    candidates = sorted(
+        ((score, pos, idx) for pos, name in enumerate(new_names) if pos not in pairs
+         for idx, score in matcher.compatible_candidates(name, limit=SHORTLIST_SIZE) if idx not in used),
+        key=lambda candidate: (-candidate[0], candidate[1], candidate[2])
+    )
+    for _, pos, idx in candidates:
+        if pos not in pairs and idx not in used:
+            pairs[pos] = idx
+            used.add(idx)
+    return pairs
+
+def _name_overlap(old_names, new_names):
+    # Share of the shorter list paired with a line of the other
+    if not old_names or not new_names:
+        return 0.0
+    return len(_pair_names(old_names, new_names)) / min(len(old_names), len(new_names))
+
+def find_revision_block(sheet, json_data, min_overlap=REVISION_MIN_OVERLAP):
+    # A quotation is a revision of a block already on the sheet when the company is the same and most of its
+    # products are already listed for that supplier. Returns (col, block rows) of the best such block, or None.
+    company = _company_key(json_data.get("company"))
+    if not company:
+        return None
+    new_names = [product["name"] for product in json_data["products"]]
+    best = None
+    for col in _block_columns(sheet):
+        if _company_key(sheet.get(COMPANY_NAME_ROW, col)) != company:
+            continue
+        rows = _block_rows(sheet, col)
+        overlap = _name_overlap(list(rows.values()), new_names)
+        # Later blocks win ties: they hold the most recent revision
+        if overlap >= min_overlap and (best is None or overlap >= best[0]):
+            best = (overlap, col, rows)
+    return best[1:] if best else None
+
+def _revises_earlier(json_data, earlier, min_overlap=REVISION_MIN_OVERLAP):
+    # Whether the quotation revises one that comes before it in the same run, by the same rule as find_revision_block
+    company = _company_key(json_data.get("company"))
+    if not company:
+        return False
+    new_names = [product["name"] for product in json_data["products"]]
+    return any(
+        _company_key(other.get("company")) == company
+        and _name_overlap([product["name"] for product in other["products"]], new_names) >= min_overlap
+        for other in earlier
+    )
+
+def is_revision(sheet, json_data, earlier):
+    # earlier holds the quotations before this one in the run that get their own block
+    return bool(find_revision_block(sheet, json_data)) or _revises_earlier(json_data, earlier)
+
+def read_master_list(sheet):
+    # The master list as update_google_sheet_with_multiple_files will find it, to build a BatchMatcher ahead of the update
+    return sheet.col_values(ITEM_MASTER_LIST_COL)[3:]
+
+def supplier_key(json_data):
+    # How a quotation is identified to a BatchMatcher
+    return tuple(product["name"] for product in json_data["products"])
+
+class SupplierFeed:
+    # Feeds a BatchMatcher, while later files are still extracting, the quotations the update will write as new
+    # supplier blocks. Files are taken in upload order, so revisions are told apart exactly as the update does.
+    def __init__(self, sheet, llm_match=request_llm_matches):
+        self.sheet = sheet
+        self.batch_matcher = BatchMatcher(read_master_list(sheet), llm_match)
+        self.new_suppliers = []
+        self._waiting = {}
+        self._next = 0
+
+    def add(self, position, json_data):
+        # position is the file's place in the upload; json_data is None for a file that failed
+        if position >= self._next:
+            self._waiting[position] = json_data
+        while self._next in self._waiting:
+            json_data = self._waiting.pop(self._next)
+            self._next += 1
+            if json_data and not is_revision(self.sheet, json_data, self.new_suppliers):
+                self.new_suppliers.append(json_data)
+                key = supplier_key(json_data)
+                self.batch_matcher.add(key, key)
+
+def _product_values(product):
+    return [product["quantity"], product["unit"], product["pricePerUnit"], product["totalPrice"]]
+
+def _add_new_products(sheet, supplier_col_start, new_products, matcher, existing_items, existing_data, start_row_index):
+    for product in new_products:
+        product_name = product["name"]
+        existing_items.append(product_name)
+        matcher.add(product_name)
+        existing_data[product_name] = len(existing_items) + start_row_index - 1
+        row_index = existing_data[product_name]
+
+        sheet.set(row_index, ITEM_MASTER_LIST_COL, product_name)
+        sheet.set_row(row_index, supplier_col_start, _product_values(product))
+
+def _summary_rows(json_data):
+    return list(zip(SUMMARY_LABELS, (json_data["totalPrice"], json_data["totalVat"], json_data["totalPriceIncludeVat"])))
+
+def _write_summary(sheet, supplier_col_start, json_data, existing_items, existing_data, start_row_index):
+    summary_start_row = max(existing_data.values()) + 2 if existing_data else start_row_index + len(existing_items) + 1
+    for offset, (label, value) in enumerate(_summary_rows(json_data)):
+        sheet.set(summary_start_row + offset, ITEM_MASTER_LIST_COL, label)
+        sheet.set(summary_start_row + offset, supplier_col_start + 3, value)
+
+def _write_new_supplier(sheet, supplier_col_start, json_data, targets, cluster_rows, matcher, existing_items, existing_data, start_row_index):
+    # targets come from BatchMatcher.finish(); cluster_rows maps the clusters that already have a row in this
+    # run, so a product new to the master list is added once and later suppliers fill in the same row
+    sheet.set(COMPANY_NAME_ROW, supplier_col_start, json_data["company"])
+    sheet.set(CONTACT_INFO_ROW, supplier_col_start, json_data["contact"] or "")
+    sheet.set_row(HEADER_ROW, supplier_col_start, SUPPLIER_HEADER)
+
+    listed = dict(existing_data)
+    matched_products = []
+    new_products = []
+    for product, (kind, target) in zip(json_data["products"], targets):
+        if kind == "existing":
+            matched_products.append((product, target + start_row_index))
+        elif product["name"] in listed:
+            # Check if this product is in the master list by exact text match
+            matched_products.append((product, listed[product["name"]]))
+        elif target in cluster_rows:
+            matched_products.append((product, cluster_rows[target]))
+        else:
+            _add_new_products(sheet, supplier_col_start, [product], matcher, existing_items, existing_data, start_row_index)
+            cluster_rows[target] = existing_data[product["name"]]
+            new_products.append(product)
+
+    for product, row_index in matched_products:
+        sheet.set_row(row_index, supplier_col_start, _product_values(product))
+    _write_summary(sheet, supplier_col_start, json_data, existing_items, existing_data, start_row_index)
+    return {"matched": len(matched_products), "new": len(new_products), "total": len(json_data["products"])}
+
+def _match_single(json_data, existing_items, llm_match):
+    batch_matcher = BatchMatcher(existing_items, llm_match)
+    key = supplier_key(json_data)
+    batch_matcher.add(key, key)
+    result = batch_matcher.finish()
+    return result["targets"][key], result["stats"][key]["llm"]
+
+def _block_values(sheet, supplier_col_start):
+    # The master-list column and the block's own columns, to count the cells a revision changes
+    cols = [ITEM_MASTER_LIST_COL] + list(range(supplier_col_start, supplier_col_start + COLUMNS_PER_SUPPLIER))
+    return {(row, col): sheet.get(row, col) for row in range(1, sheet.row_count() + 1) for col in cols}
+
+def _update_revision(sheet, supplier_col_start, block_rows, json_data, matcher, existing_items, existing_data, start_row_index, llm_match):
+    # Diffs the revision against the supplier's block: lines are paired with the block's rows by the same rule
+    # that found the block, so only products the block has never had go through matching, and SheetModel drops
+    # every value that did not change
+    sheet.set(COMPANY_NAME_ROW, supplier_col_start, json_data["company"])
+    sheet.set(CONTACT_INFO_ROW, supplier_col_start, json_data["contact"] or "")
+
+    block_row_list = list(block_rows)
+    pairs = _pair_names(list(block_rows.values()), [product["name"] for product in json_data["products"]])
+    assigned = {}
+    unresolved = []
+    for pos, product in enumerate(json_data["products"]):
+        row = block_row_list[pairs[pos]] if pos in pairs else existing_data.get(product["name"])
+        if row is None:
+            unresolved.append(product)
+        else:
+            # A name listed twice lands on one row, the last one winning, as on the first upload
+            assigned[row] = product
+
+    llm = 0
+    new_products = []
+    if unresolved:
+        match_indices, match_sources = match_products(matcher, [product["name"] for product in unresolved], llm_match=llm_match)
+        llm = match_sources["llm"]
+        for product, match_idx in zip(unresolved, match_indices):
+            if match_idx >= 0:
+                assigned[match_idx + start_row_index] = product
+            else:
+                new_products.append(product)
+
+    for row, product in assigned.items():
+        sheet.set_row(row, supplier_col_start, _product_values(product))
+    removed = [row for row in block_rows if row not in assigned]
+    for row in removed:
+        sheet.set_row(row, supplier_col_start, [""] * COLUMNS_PER_SUPPLIER)
+    _add_new_products(sheet, supplier_col_start, new_products, matcher, existing_items, existing_data, start_row_index)
+
+    # The totals go where this block already has them, unless new rows now sit below that
+    summary_rows = _block_summary_rows(sheet, supplier_col_start)
+    last_item_row = max(list(assigned) + [existing_data[product["name"]] for product in new_products] + [0])
+    if len(summary_rows) == len(SUMMARY_LABELS) and summary_rows[0] > last_item_row:
+        for row, (_, value) in zip(summary_rows, _summary_rows(json_data)):
+            sheet.set(row, supplier_col_start + 3, value)
+    else:
+        for row in summary_rows:
+            sheet.set(row, supplier_col_start + 3, "")
+        _write_summary(sheet, supplier_col_start, json_data, existing_items, existing_data, start_row_index)
+
+    return {"matched": len(assigned), "new": len(new_products), "removed": len(removed), "llm": llm}
+
+def update_google_sheet_with_multiple_files(worksheet, all_json_data, match_stats=None, on_status=None, on_warning=None, llm_match=request_llm_matches, batch_matcher=None, sheet=None):
+    # batch_matcher may already hold some of the quotations (fed while later files were still extracting);
+    # it is used when it was built on the master list the sheet has now. sheet is the SheetModel of worksheet if
+    # it was loaded already (SupplierFeed.sheet), for callers that know nothing has written to the worksheet since;
+    # the app reads it again, since another tab may have applied a batch meanwhile.
+    if sheet is None:
+        sheet = SheetModel(worksheet)
+    ensure_first_three_rows_exist(sheet)
+
+    # Check if sheet template is valid
+    has_valid_template = check_sheet_template(sheet)
+    if not has_valid_template and on_warning:
+        on_warning("Sheet template is not valid. Creating basic template.")
+
+    # Get existing items and their metadata
+    existing_items = sheet.col_values(ITEM_MASTER_LIST_COL)[3:]
+    existing_data = {}
+
+    # Create a mapping of product names to their row indices
+    for i in range(HEADER_ROW + 1, sheet.row_count() + 1):
+        name = sheet.get(i, ITEM_MASTER_LIST_COL)
+        if name.strip():
+            existing_data[name] = i
+
+    start_row_index = 4
+    matcher = ProductMatcher(existing_items)
+    supplier_stats = {}
+
+    if all_json_data:
+        # Find the next available column after the last used column
+        next_col = find_next_available_column(sheet)
+
+        # Revisions of a block (on the sheet, or written earlier in this run) are applied after the new blocks
+        new_suppliers = []
+        revisions = []
+        for idx, json_data in enumerate(all_json_data):
+            if is_revision(sheet, json_data, [all_json_data[i] for i in new_suppliers]):
+                revisions.append(idx)
+            else:
+                new_suppliers.append(idx)
+
+        # Every new supplier is matched in one pass: ambiguous names from all of them share the LLM batches
+        if new_suppliers:
+            if on_status:
+                on_status(f"Matching products for {len(new_suppliers)} supplier(s)...")
+            if batch_matcher is None or batch_matcher.existing_products != existing_items:
+                batch_matcher = BatchMatcher(existing_items, llm_match)
+            keys = [supplier_key(all_json_data[idx]) for idx in new_suppliers]
+            for key in keys:
+                batch_matcher.add(key, key)
+            batch = batch_matcher.finish(keys)
+
+        cluster_rows = {}
+        for idx in new_suppliers:
+            json_data = all_json_data[idx]
+            key = supplier_key(json_data)
+            stats = _write_new_supplier(sheet, next_col, json_data, batch["targets"][key], cluster_rows, matcher, existing_items, existing_data, start_row_index)
+            next_col += COLUMNS_PER_SUPPLIER
+            supplier_stats[idx] = dict(stats, llm=batch["stats"][key]["llm"])
+
+        for idx in revisions:
+            json_data = all_json_data[idx]
+            revision = find_revision_block(sheet, json_data)
+            if revision:
+                supplier_col_start, block_rows = revision
+                if on_status:
+                    on_status(f"Updating supplier {idx+1} as a revision of column {column_letter(supplier_col_start)}...")
+                before = _block_values(sheet, supplier_col_start)
+                stats = _update_revision(sheet, supplier_col_start, block_rows, json_data, matcher, existing_items, existing_data, start_row_index, llm_match)
+                after = _block_values(sheet, supplier_col_start)
+                cells = sum(not _same_value(before.get(cell, ""), value) for cell, value in after.items())
+                supplier_stats[idx] = dict(stats, total=len(json_data["products"]), revision=column_letter(supplier_col_start), cells=cells)
+                continue
+
+            # The earlier quotation's products landed on rows under other names, so this one gets its own block
+            if on_status:
+                on_status(f"Matching products for supplier {idx+1}...")
+            targets, llm = _match_single(json_data, existing_items, llm_match)
+            stats = _write_new_supplier(sheet, next_col, json_data, targets, {}, matcher, existing_items, existing_data, start_row_index)
+            next_col += COLUMNS_PER_SUPPLIER
+            supplier_stats[idx] = dict(stats, llm=llm)
+
+    sheet.flush()
+    if match_stats is not None:
+        # In upload order, not the order the blocks were written in
+        match_stats.update(sorted(supplier_stats.items()))
+
+    return len(all_json_data)
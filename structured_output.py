@@ -0,0 +1,104 @@
+import os
+
+# Native JSON output mode: the model fills a response_schema using short keys, and the result is expanded
+# locally into the {company, vat, products[...], totalPrice...} shape the rest of the app works with
+
+STRUCTURED_OUTPUT_ENABLED = os.getenv("STRUCTURED_OUTPUT", "").lower() in ("1", "true", "yes")
+
+DOCUMENT_KEYS = {
+    "c": "company",
+    "v": "vat",
+    "n": "name",
+    "ct": "contact",
+    "g": "priceGuaranteeDay",
+    "tp": "totalPrice",
+    "tv": "totalVat",
+    "ti": "totalPriceIncludeVat",
+}
+PRODUCT_KEYS = {"n": "name", "q": "quantity", "u": "unit", "pu": "pricePerUnit", "t": "totalPrice"}
+SUMMARY_KEYS = {"l": "label", "v": "value"}
+
+_STRING = {"type": "string"}
+_NULLABLE_STRING = {"type": "string", "nullable": True}
+_NUMBER = {"type": "number"}
+
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "c": _STRING,
+        "v": {"type": "boolean"},
+        "n": _NULLABLE_STRING,
+        "ct": _NULLABLE_STRING,
+        "g": {"type": "integer"},
+        "p": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"n": _STRING, "q": _NUMBER, "u": _STRING, "pu": _NUMBER, "t": _NUMBER},
+                "required": ["n", "q", "u", "pu", "t"],
+            },
+        },
+        "s": {
+            "type": "array",
+            "items": {"type": "object", "properties": {"l": _STRING, "v": _NUMBER}, "required": ["l", "v"]},
+        },
+        "tp": _NUMBER,
+        "tv": _NUMBER,
+        "ti": _NUMBER,
+    },
+    "required": ["c", "v", "p", "tp", "tv", "ti"],
+}
+
+MATCHING_SCHEMA = {"type": "array", "items": {"type": "integer"}}
+
+COMPACT_OUTPUT_SECTION = """## Output Format (compact JSON)
+Return the JSON object defined by the response schema. It uses short keys:
+* c = company (company name or first name + last name, NEVER empty), v = vat, n = customer name or null,
+  ct = contact (phone number or email or null), g = priceGuaranteeDay
+* p = products, one object per line item: n = name, q = quantity, u = unit, pu = pricePerUnit, t = totalPrice
+* s = summaryItems, one object per summary line: l = label, v = value
+* tp = totalPrice, tv = totalVat, ti = totalPriceIncludeVat
+All guidelines below refer to the full field names; apply them to the matching short keys.
+
+"""
+
+def compact_prompt(prompt):
+    # Swaps the verbose JSON example for the short-key legend; the extraction rules are unchanged
+    start = prompt.find("## Output Format")
+    end = prompt.find("## Field Extraction Guidelines")
+    if start < 0 or end < start:
+        return prompt + "\n" + COMPACT_OUTPUT_SECTION
+    return prompt[:start] + COMPACT_OUTPUT_SECTION + prompt[end:]
+
+def extraction_generation_config():
+    return {"response_mime_type": "application/json", "response_schema": EXTRACTION_SCHEMA}
+
+def matching_generation_config():
+    return {"response_mime_type": "application/json", "response_schema": MATCHING_SCHEMA}
+
+def expand_product(product):
+    return {PRODUCT_KEYS.get(key, key): value for key, value in product.items()}
+
+def expand_document(data):
+    if not isinstance(data, dict):
+        return None
+    document = {DOCUMENT_KEYS.get(key, key): value for key, value in data.items() if key not in ("p", "s")}
+    document["products"] = [expand_product(product) for product in data.get("p") or []]
+    if "s" in data:
+        document["summaryItems"] = [{SUMMARY_KEYS.get(key, key): value for key, value in item.items()} for item in data["s"] or []]
+    document.setdefault("company", "")
+    for field in ("totalPrice", "totalVat", "totalPriceIncludeVat"):
+        if document.get(field) is None:
+            document[field] = 0
+    return document
+
+def compact_document(document):
+    # Inverse of expand_document, used to compare output sizes of the two formats on recorded extractions
+    full_to_short = {full: short for short, full in DOCUMENT_KEYS.items()}
+    product_keys = {full: short for short, full in PRODUCT_KEYS.items()}
+    summary_keys = {full: short for short, full in SUMMARY_KEYS.items()}
+    data = {full_to_short[key]: value for key, value in document.items() if key in full_to_short}
+    data["p"] = [{product_keys[key]: value for key, value in product.items() if key in product_keys} for product in document.get("products") or []]
+    if document.get("summaryItems"):
+        data["s"] = [{summary_keys[key]: value for key, value in item.items() if key in summary_keys} for item in document["summaryItems"]]
+    return data
@@ -0,0 +1,194 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from extraction import parse_response
+from extraction_cache import make_cache_key
+from pdf_text import build_text_prompt, has_usable_text_layer, read_text_layer
+
+# Arithmetic checks over extracted quotations and targeted re-extraction of the rows that fail them
+
+VAT_RATE = 0.07
+VALIDATION_TOLERANCE = float(os.getenv("VALIDATION_TOLERANCE", "1.0"))
+VALIDATION_RELATIVE_TOLERANCE = float(os.getenv("VALIDATION_RELATIVE_TOLERANCE", "0.001"))
+RECHECK_CONCURRENCY = int(os.getenv("RECHECK_CONCURRENCY", "4"))
+
+ROW_CHECKS = ("missing_number", "row_total_mismatch")
+ANOMALY_COLUMNS = ["document", "file", "row", "product", "check", "expected", "actual", "difference"]
+
+RECHECK_NOTE = """## Targeted Re-check
+An earlier extraction of this quotation returned the line items below, but their numbers do not add up
+(totalPrice must equal quantity x pricePerUnit). Read ONLY these line items again from the document and return
+the usual JSON object with exactly these line items in "products", in the same order, with every number copied
+exactly as printed. Do not include any other line items.
+
+{rows}
+"""
+
+def _outside_tolerance(actual, expected):
+    return np.abs(actual - expected) > np.maximum(VALIDATION_TOLERANCE, VALIDATION_RELATIVE_TOLERANCE * np.abs(expected))
+
+def products_frame(documents):
+    # One row per product across all documents
+    document, row, names, quantity, price, total = [], [], [], [], [], []
+    for doc_idx, data in enumerate(documents):
+        for row_idx, product in enumerate(data.get("products") or []):
+            document.append(doc_idx)
+            row.append(row_idx)
+            names.append(product.get("name"))
+            quantity.append(product.get("quantity"))
+            price.append(product.get("pricePerUnit"))
+            total.append(product.get("totalPrice"))
+    return pd.DataFrame({
+        "document": np.array(document, dtype=np.int64),
+        "row": np.array(row, dtype=np.int64),
+        "product": names,
+        "quantity": pd.to_numeric(pd.Series(quantity, dtype=object), errors="coerce"),
+        "pricePerUnit": pd.to_numeric(pd.Series(price, dtype=object), errors="coerce"),
+        "totalPrice": pd.to_numeric(pd.Series(total, dtype=object), errors="coerce"),
+    })
+
+def validate_documents(documents, names=None):
+    # Checks every product of every document in one vectorised pass and returns one row per anomaly.
+    # Row checks: quantity x pricePerUnit = totalPrice. Document checks: product totals = totalPrice,
+    # totalVat = 7% of totalPrice (when vat is set), totalPriceIncludeVat = totalPrice + totalVat.
+    names = names or [f"document {i + 1}" for i in range(len(documents))]
+    products = products_frame(documents)
+    expected_total = products["quantity"] * products["pricePerUnit"]
+    missing = products[["quantity", "pricePerUnit", "totalPrice"]].isna().any(axis=1)
+    mismatch = ~missing & _outside_tolerance(products["totalPrice"], expected_total)
+
+    frames = []
+    for check, mask in (("missing_number", missing), ("row_total_mismatch", mismatch)):
+        if mask.any():
+            frames.append(pd.DataFrame({
+                "document": products["document"][mask],
+                "row": products["row"][mask],
+                "product": products["product"][mask],
+                "check": check,
+                "expected": expected_total[mask],
+                "actual": products["totalPrice"][mask],
+            }))
+
+    summary = pd.DataFrame({
+        "document": np.arange(len(documents), dtype=np.int64),
+        "vat": [bool(data.get("vat")) for data in documents],
+        "totalPrice": pd.to_numeric(pd.Series([data.get("totalPrice") for data in documents], dtype=object), errors="coerce"),
+        "totalVat": pd.to_numeric(pd.Series([data.get("totalVat") for data in documents], dtype=object), errors="coerce"),
+        "totalPriceIncludeVat": pd.to_numeric(pd.Series([data.get("totalPriceIncludeVat") for data in documents], dtype=object), errors="coerce"),
+    })
+    product_sum = products.groupby("document")["totalPrice"].sum().reindex(summary["document"], fill_value=0.0).to_numpy()
+    document_checks = (
+        ("subtotal_mismatch", summary["totalPrice"], product_sum, np.ones(len(summary), dtype=bool)),
+        ("vat_mismatch", summary["totalVat"], summary["totalPrice"] * VAT_RATE, summary["vat"].to_numpy()),
+        ("grand_total_mismatch", summary["totalPriceIncludeVat"], summary["totalPrice"] + summary["totalVat"], np.ones(len(summary), dtype=bool)),
+    )
+    for check, actual, expected, applies in document_checks:
+        expected = pd.Series(np.asarray(expected, dtype=float), index=summary.index)
+        mask = applies & actual.notna().to_numpy() & _outside_tolerance(actual, expected).to_numpy()
+        if mask.any():
+            frames.append(pd.DataFrame({
+                "document": summary["document"][mask],
+                "row": -1,
+                "product": None,
+                "check": check,
+                "expected": expected[mask],
+                "actual": actual[mask],
+            }))
+
+    if not frames:
+        return pd.DataFrame(columns=ANOMALY_COLUMNS)
+    anomalies = pd.concat(frames, ignore_index=True)
+    anomalies["file"] = [names[i] for i in anomalies["document"]]
+    anomalies["difference"] = (anomalies["actual"] - anomalies["expected"]).round(2)
+    return anomalies.sort_values(["document", "row"], kind="stable").reset_index(drop=True)[ANOMALY_COLUMNS]
+
+def _locate_pages(page_texts, product_names):
+    # Page whose text shares the most words with each product name; None if any row cannot be placed
+    pages = set()
+    for name in product_names:
+        words = [word for word in str(name).split() if len(word) > 1]
+        scores = [sum(word in text for word in words) for text in page_texts]
+        if not words or max(scores) == 0:
+            return None
+        pages.add(int(np.argmax(scores)))
+    return sorted(pages)
+
+def _row_passes(product):
+    try:
+        quantity, price, total = float(product["quantity"]), float(product["pricePerUnit"]), float(product["totalPrice"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return not _outside_tolerance(np.float64(total), np.float64(quantity * price))
+
+def recheck_document(client, file_name, file_bytes, data, rows):
+    # Asks the model for just the failing rows, from just the pages they are on when the text layer allows it
+    products = data.get("products") or []
+    listed = "\n".join(f"{i + 1}. {json.dumps(products[row], ensure_ascii=False)}" for i, row in enumerate(rows))
+    recheck_prompt = f"{client.prompt}\n\n{RECHECK_NOTE.format(rows=listed)}"
+
+    try:
+        page_texts = read_text_layer(file_bytes)
+    except Exception:
+        page_texts = None
+    page_count = len(page_texts) if page_texts else None
+    targets = _locate_pages(page_texts, [products[row].get("name", "") for row in rows]) if page_texts and has_usable_text_layer(page_texts) else None
+
+    with metrics.span("recheck"):
+        if targets:
+            first, last = targets[0], targets[-1]
+            text_prompt = build_text_prompt(recheck_prompt, page_texts[first:last + 1], first_page=first + 1)
+            response = client.extract_text(f"{file_name} [pages {first + 1}-{last + 1}]", text_prompt)
+            pages_sent = last - first + 1
+        else:
+            # No usable text layer to locate the rows: the whole file goes again (an earlier upload is reused),
+            # but the answer is only the listed rows
+            response = client.extract(file_name, file_bytes, prompt=recheck_prompt)
+            pages_sent = page_count
+    corrected = (parse_response(client, response) or {}).get("products") or []
+
+    if len(corrected) != len(rows):
+        # Fall back to pairing by name when the model returned a different number of rows
+        by_name = {" ".join(str(product.get("name", "")).split()): product for product in corrected}
+        corrected = [by_name.get(" ".join(str(products[row].get("name", "")).split())) for row in rows]
+
+    fixed = dict(data, products=list(products))
+    fixed_rows = 0
+    for row, product in zip(rows, corrected):
+        if product and _row_passes(product):
+            fixed["products"][row] = dict(products[row], **{key: product[key] for key in ("quantity", "unit", "pricePerUnit", "totalPrice") if key in product})
+            fixed_rows += 1
+    return fixed, {"rows": len(rows), "fixed": fixed_rows, "pages_sent": pages_sent, "pages_total": page_count}
+
+def recheck_documents(client, files, documents, anomalies, cache=None, max_workers=RECHECK_CONCURRENCY):
+    # files[i] is the (name, bytes) pair documents[i] was extracted from; only documents with failing rows are re-sent
+    failing = anomalies[anomalies["check"].isin(ROW_CHECKS)]
+    rows_by_document = {int(doc): sorted(set(group["row"].astype(int))) for doc, group in failing.groupby("document")}
+    documents = list(documents)
+    summary = {"documents": len(rows_by_document), "rows": 0, "fixed": 0, "pages_sent": 0, "pages_total": 0, "errors": []}
+    if not rows_by_document:
+        return documents, summary
+
+    def run(doc_idx):
+        file_name, file_bytes = files[doc_idx]
+        return doc_idx, recheck_document(client, file_name, file_bytes, documents[doc_idx], rows_by_document[doc_idx])
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(rows_by_document)))) as executor:
+        futures = [executor.submit(metrics.carry(run), doc_idx) for doc_idx in rows_by_document]
+        for future in futures:
+            try:
+                doc_idx, (fixed, stats) = future.result()
+            except Exception as e:
+                summary["errors"].append(str(e))
+                continue
+            documents[doc_idx] = fixed
+            for key in ("rows", "fixed", "pages_sent", "pages_total"):
+                summary[key] += stats[key] or 0
+            if stats["fixed"] and cache is not None and cache.enabled:
+                file_bytes = files[doc_idx][1]
+                cache.put(make_cache_key(file_bytes, client.prompt, client.model_name), fixed)
+    return documents, summary
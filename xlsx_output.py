@@ -0,0 +1,89 @@
+import io
+import re
+
+from openpyxl import Workbook, load_workbook
+
+from sheets import ITEM_MASTER_LIST_COL, column_letter
+
+# Local output backend for the comparison table: answers the same two calls SheetModel makes on a gspread
+# worksheet (get_all_values, batch_update) from an in-memory grid, and saves the grid with openpyxl's
+# write-only (streaming) writer. No network round trips and no Sheets quota.
+
+# Sheets parses USER_ENTERED text like "1,234.50" into a number; the xlsx gets the same numbers
+NUMBER_PATTERN = re.compile(r"^-?(\d{1,3}(,\d{3})+|\d+)?(\.\d+)?$")
+
+def _display(value):
+    # What the Sheets API would return for a cell read back as formatted text
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def _cell(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str) and any(ch.isdigit() for ch in value) and NUMBER_PATTERN.match(value.strip()):
+        number = float(value.strip().replace(",", ""))
+        return int(number) if number.is_integer() and "." not in value else number
+    return value
+
+def _parse_cell(cell):
+    letters = cell.rstrip("0123456789")
+    col = 0
+    for letter in letters.upper():
+        col = col * 26 + ord(letter) - ord("A") + 1
+    return int(cell[len(letters):]), col
+
+class LocalWorksheet:
+    # Rate limiting only protects the Sheets API; this backend never leaves the process
+    local = True
+
+    def __init__(self, rows=None, title="Comparison"):
+        self.rows = [list(row) for row in (rows or [])]
+        self.title = title
+
+    @classmethod
+    def from_xlsx(cls, source, sheet_index=0):
+        # Starts from an existing comparison workbook (a path or a file-like object); only cell values are kept
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        try:
+            worksheet = workbook.worksheets[sheet_index]
+            rows = [list(row) for row in worksheet.iter_rows(values_only=True)]
+            title = worksheet.title
+        finally:
+            workbook.close()
+        return cls(rows, title)
+
+    def get_all_values(self):
+        width = max((len(row) for row in self.rows), default=0)
+        return [[_display(value) for value in row] + [""] * (width - len(row)) for row in self.rows]
+
+    def batch_update(self, data, value_input_option=None):
+        for update in data:
+            start, _, _ = update["range"].partition(":")
+            start_row, start_col = _parse_cell(start)
+            for row_offset, values in enumerate(update["values"]):
+                for col_offset, value in enumerate(values):
+                    self._write(start_row + row_offset, start_col + col_offset, value)
+
+    def _write(self, row, col, value):
+        if len(self.rows) < row:
+            self.rows.extend([] for _ in range(row - len(self.rows)))
+        if len(self.rows[row - 1]) < col:
+            self.rows[row - 1].extend([None] * (col - len(self.rows[row - 1])))
+        self.rows[row - 1][col - 1] = None if value == "" else value
+
+    def save(self, target):
+        # Write-only mode streams rows to the file instead of building openpyxl cell objects for the whole sheet
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet(self.title)
+        worksheet.column_dimensions[column_letter(ITEM_MASTER_LIST_COL)].width = 60
+        for row in self.rows:
+            worksheet.append([_cell(value) for value in row])
+        workbook.save(target)
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        self.save(buffer)
+        return buffer.getvalue()